@@ -0,0 +1,188 @@
+"""Run extracts for many districts from the command line, without the UI.
+
+Extracts run side by side in worker processes, so one district failing
+can't take the others down. Each worker keeps its database connections
+warm from one district to the next and is replaced after a few
+districts to hand its memory back. Failed extracts are retried, and a
+summary of every run is printed and saved at the end.
+
+    python batch.py --file districts.txt
+    python batch.py 1234 5678 --extract parcc --processes 8 --db-slots 6
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import os.path
+import sys
+import time
+import pandas as pd
+import extract_benchmark
+import extract_parcc
+import queries
+import query_cache
+
+_extracts = {
+    'benchmark': extract_benchmark.extract,
+    'parcc': extract_parcc.extract,
+}
+# Seconds to wait before the first retry; doubled before each one after.
+_backoff = 30
+# Extracts a worker process runs before it is replaced with a fresh one.
+_recycle = 10
+
+
+def read_district_ids(values=(), path=None):
+    """Return district IDs from values and from a file, in order, once.
+
+    path -- text file with IDs separated by whitespace or commas; the
+        rest of a line after # is ignored
+    """
+    ids = [str(value) for value in values]
+    if path is not None:
+        with open(path, 'r') as file:
+            for line in file:
+                ids.extend(line.split('#')[0].replace(',', ' ').split())
+    return list(dict.fromkeys(int(value) for value in ids))
+
+
+def init_worker(slots, refresh):
+    """Set up a worker process to share the batch's query slots."""
+    queries.set_slots(slots)
+    query_cache.set_refresh(refresh)
+
+
+def run_extract(task):
+    """Run one extract for one district, retrying it if it fails.
+
+    task -- (districtID, extract name, retries, keyword arguments for
+        the extract function)
+
+    Returns a summary row for the run. Exceptions never escape, so one
+    district can't stop the batch.
+    """
+    districtID, name, retries, options = task
+    start = time.perf_counter()
+    for attempt in range(1, retries + 2):
+        try:
+            message = _extracts[name](districtID, **options)
+        except Exception as ex:
+            detail = "{}: {}".format(type(ex).__name__, ex)
+            print("District {} {} attempt {} failed. {}".format(
+                districtID, name, attempt, detail))
+            if attempt <= retries:
+                time.sleep(_backoff * 2 ** (attempt - 1))
+        else:
+            status, detail = 'OK', message.splitlines()[-1]
+            break
+    else:
+        status = 'Failed'
+    return {
+        'District': districtID, 'Extract': name, 'Status': status,
+        'Attempts': attempt,
+        'Seconds': round(time.perf_counter() - start, 1),
+        'Detail': detail}
+
+
+def run_batch(districtIDs, names, processes=None, db_slots=None,
+              retries=2, refresh=False, recycle=None, **options):
+    """Run every extract in names for every district and summarize them.
+
+    processes -- worker processes (default: one per core)
+    db_slots -- most queries running on the server at once across all
+        workers (default: EXTRACTOR_DB_WORKERS from the environment, or
+        4)
+    retries -- times to retry a failed extract
+    refresh -- ignore cached query results
+    recycle -- extracts each worker runs before it is replaced
+        (default: 10)
+    options -- passed on to every extract, e.g. chunksize
+
+    Returns the summary as a DataFrame, one row per district and
+    extract.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if db_slots is None:
+        db_slots = int(os.environ.get("EXTRACTOR_DB_WORKERS", 4))
+    if recycle is None:
+        recycle = _recycle
+    tasks = [(districtID, name, retries, options)
+             for districtID in districtIDs for name in names]
+    slots = multiprocessing.BoundedSemaphore(max(1, db_slots))
+    rows = []
+    # Workers live for several extracts so their connection pools stay
+    # warm, but not forever, so memory a big district used is returned.
+    with multiprocessing.Pool(max(1, min(processes, len(tasks) or 1)),
+                              init_worker, (slots, refresh),
+                              maxtasksperchild=max(1, recycle)) as pool:
+        for row in pool.imap_unordered(run_extract, tasks):
+            rows.append(row)
+            print("[{}/{}] District {} {}: {} in {}s".format(
+                len(rows), len(tasks), row['District'], row['Extract'],
+                row['Status'], row['Seconds']))
+    columns = ['District', 'Extract', 'Status', 'Attempts', 'Seconds',
+               'Detail']
+    summary = pd.DataFrame(rows, columns=columns)
+    return summary.sort_values(['District', 'Extract'], ignore_index=True)
+
+
+def save_summary(summary):
+    """Save a batch summary to the Extracts folder and return its path."""
+    extracts = os.path.join(os.getcwd(), "Extracts")
+    os.makedirs(extracts, exist_ok=True)
+    path = os.path.join(extracts, "Batch Summary {}.csv".format(
+        datetime.datetime.now().strftime("%Y-%m-%d %H%M%S")))
+    summary.to_csv(path, index=False)
+    return path
+
+
+def main(argv=None):
+    """Parse the command line, run the batch and report on it."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("districts", nargs="*", type=int, default=[],
+                        metavar="DISTRICTID")
+    parser.add_argument("--extract", action="append", dest="extracts",
+                        choices=sorted(_extracts),
+                        help="extract to run, may be repeated "
+                        "(default: all of them)")
+    parser.add_argument("--file", help="file of district IDs to run")
+    parser.add_argument("--processes", type=int,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--db-slots", type=int,
+                        help="most queries on the server at once")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="times to retry a failed extract")
+    parser.add_argument("--chunksize", type=int,
+                        help="stream row-level results this many at a time, "
+                        "0 to read them whole (default: 50000)")
+    parser.add_argument("--delta-only", action="store_true",
+                        help="write only rows changed since the last delta")
+    parser.add_argument("--refresh", action="store_true",
+                        help="ignore cached query results")
+    parser.add_argument("--recycle", type=int,
+                        help="extracts each worker runs before it is "
+                        "replaced (default: {})".format(_recycle))
+    args = parser.parse_args(argv)
+    districtIDs = read_district_ids(args.districts, args.file)
+    if not districtIDs:
+        parser.error("no district IDs given")
+    names = list(dict.fromkeys(args.extracts or _extracts))
+    summary = run_batch(
+        districtIDs, names, processes=args.processes,
+        db_slots=args.db_slots, retries=args.retries,
+        refresh=args.refresh, recycle=args.recycle,
+        chunksize=args.chunksize,
+        delta_only=args.delta_only)
+    print(summary.to_string(index=False))
+    failed = (summary.Status != 'OK').sum()
+    print("{} of {} extracts succeeded. Summary saved to {}".format(
+        len(summary) - failed, len(summary), save_summary(summary)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""Time Benchmark Status completion marking on growing synthetic rosters.
+
+Builds a roster and about results_per_student benchmark results for
+each student, then times completion_index and status_sheets for all
+three forms. Each step doubles the roster, so with linear growth the
+time per student stays flat and each step takes about twice as long as
+the last.
+
+    python bench_status.py
+    python bench_status.py --students 20000 --steps 5
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import benchmark_status
+
+
+def synthetic(students, results_per_student=6, seed=0):
+    """Return a roster and benchmark results frame for students."""
+    rng = np.random.default_rng(seed)
+    codes = pd.Series(np.arange(students)).map("S{:07d}".format)
+    df_s = pd.DataFrame({
+        "School": "School", "LastName": "Last", "FirstName": "First",
+        "MiddleName": "", "Code": codes, "Grade": "3"})
+    n = students * results_per_student
+    df_b = pd.DataFrame({
+        "StudentCode": codes.sample(
+            n, replace=True, random_state=seed).to_numpy(),
+        "Subject": rng.choice(list(benchmark_status._subjects.values()), n),
+        "Form": rng.choice(benchmark_status._forms + [" "], n)})
+    return df_s, df_b
+
+
+def time_run(df_s, df_b, repeat=3):
+    """Return the best of repeat timings of marking every form, in s."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        index = benchmark_status.completion_index(df_b)
+        benchmark_status.status_sheets(df_s, index, benchmark_status._forms)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(students=10000, steps=4, results_per_student=6):
+    """Print the timing of each roster size and its growth."""
+    print("{:>10} {:>10} {:>10} {:>14}".format(
+        "students", "results", "seconds", "us/student"))
+    last = None
+    for step in range(steps):
+        size = students * 2 ** step
+        df_s, df_b = synthetic(size, results_per_student)
+        elapsed = time_run(df_s, df_b)
+        growth = "" if last is None else "  x{:.2f}".format(elapsed / last)
+        print("{:>10} {:>10} {:>10.3f} {:>14.2f}{}".format(
+            size, len(df_b), elapsed, elapsed / size * 1e6, growth))
+        last = elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=10000,
+                        help="roster size of the first step")
+    parser.add_argument("--steps", type=int, default=4,
+                        help="times to double the roster")
+    parser.add_argument("--results", type=int, default=6,
+                        help="benchmark results per student")
+    args = parser.parse_args()
+    main(args.students, args.steps, args.results)
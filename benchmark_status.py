@@ -1,10 +1,23 @@
 """Extract Benchmark Status data to send to client."""
-import mal_data as mal
+import connection_pool
+import argparse
 import datetime
-import pandas as pd
 import os
 import os.path
-_students = """ declare  @districtid int = '{}'
+import time
+import districts
+import queries
+import query_cache
+import result_store
+import sheet_writer
+
+_forms = ["A", "B", "C"]
+_subjects = {"ELA": "Language Arts", "Math": "Math"}
+# Seconds between watch polls that also drop deleted results.
+_deleted_check = 24 * 3600
+
+_students = queries.register("status.students", """
+declare  @districtid int = ?
 
 SELECT  DISTINCT
 
@@ -29,11 +42,14 @@ LEFT JOIN Grade WITH
 (NOLOCK) ON Student.CurrentGradeID = Grade.GradeID
 WHERE STUDENT.DISTRICTID = @districtid AND DistrictTerm.Active = 1
 order by School, [Grade], LastName, FirstName, Student.Code
-"""
+""")
 
-_benchmarks = """declare  @districtid int = '{}', @resultdate datetime =
-'{}-08-01'
-select tr.UpdatedDate as [ResultDate], dt.name as DistrictTerm,
+# Synced into the local result store, inactive terms included.
+_benchmarks = queries.register("status.benchmarks", """
+declare @since datetime = ?
+declare  @districtid int = ?, @resultdate datetime = ?
+select tr.TestResultID, tr.UpdatedDate, dt.DistrictTermID,
+tr.UpdatedDate as [ResultDate], dt.name as DistrictTerm,
 vt.name as TestName, sub.name as Subject, gr.name as Grade,
 sch.Name as School, u.UserID, u.code as TeacherCode,
 u.NameFirst as TeacherFirstName, u.NameLast as TeacherLastName,
@@ -51,58 +67,171 @@ join school sch With (nolock) on sch.SchoolID=tr.SchoolID
 join class c With (nolock) on c.classid=tr.classid
 join DistrictTerm dt With (nolock) on dt.DistrictTermID=c.DistrictTermID
 join [user] u With (nolock) on u.userid=tr.userid
-where dt.DistrictID=@districtid and dt.Active = 1
+where dt.DistrictID=@districtid and tr.UpdatedDate > @since
 and vt.Name like '%LinkIt%form%' and not
 (vt.Name like '%retake%' or vt.Name like '%LinkIt%form%CR%')
-"""
+""")
 
+_active_terms = queries.register("status.active_terms", """
+select DistrictTermID from DistrictTerm with (nolock)
+where DistrictID = ? and Active = 1
+""")
 
-def find_score(code, subj, df, form_letter):
-    """Check df for a score matching subj, form_letter and row."""
-    expr = ("StudentCode == '{}' "
-            "and Subject == '{}' "
-            "and Form == '{}'").format(code, subj, form_letter)
-    query = df.query(expr)
-    if not query.empty:
-        return True
-    return False
 
+def completion_index(df):
+    """Return the unique (StudentCode, Subject, Form) keys found in df."""
+    return df[["StudentCode", "Subject", "Form"]].drop_duplicates()
 
-def main(districtID, form):
-    """Extract Benchmark Status data and save as spreadsheet."""
-    global _students
-    global _benchmarks
-    connection = mal.setup_SQL()
-    df_s = pd.read_sql(_students.format(districtID), connection)
-    sql_b = _benchmarks.format(districtID,
-                               datetime.date.today().year - 1)
-    df_b = pd.read_sql(sql_b, connection)
-    df_b["Form"] = df_b.apply(
-        lambda row: row.TestName[row.TestName.find("Form") + 5] if
-        ("Form" in row.TestName) else " ", axis=1)
-    df_s["ELA"] = df_s.apply(
-        lambda row: "Yes" if find_score(
-            row["Code"],
-            "Language Arts", df_b, form) else "No", axis=1)
-    df_s["Math"] = df_s.apply(
-        lambda row: "Yes" if find_score(
-            row["Code"],
-            "Math", df_b, form) else "No", axis=1)
-
-    file_name = "Benchmark Status\\{} Form {} Benchmark Status {}".format(
-        mal.get_district_name(districtID),
-        form,
+
+def mark_completion(df_s, index, subj, form_letter):
+    """Return a Yes/No Series of df_s students with a subj score on form."""
+    done = index[(index.Subject == subj) & (index.Form == form_letter)]
+    found = df_s["Code"].isin(done["StudentCode"])
+    return found.map({True: "Yes", False: "No"})
+
+
+def status_sheets(df_s, index, forms):
+    """Return a sheet name -> roster frame dict with Yes/No per subject.
+
+    One sheet is built per form letter, all from the same index, so
+    asking for every form costs no extra queries.
+    """
+    sheets = {}
+    for form in forms:
+        sheet = df_s.copy()
+        for column, subj in _subjects.items():
+            sheet[column] = mark_completion(df_s, index, subj, form)
+        name = "Students" if len(forms) == 1 else "Form " + form
+        sheets[name] = sheet
+    return sheets
+
+
+def sync_results(districtID, ids=None):
+    """Bring the district's stored benchmark results up to date.
+
+    ids -- passed on to result_store.sync
+
+    Returns the watermark synced from, as result_store.sync does.
+    """
+    params = [int(districtID),
+              datetime.datetime(datetime.date.today().year - 1, 8, 1)]
+    return result_store.sync(_benchmarks, districtID, params,
+                             connection_pool.setup_SQL,
+                             parse_dates=["ResultDate"], ids=ids)
+
+
+def fetch_results(connection, districtID):
+    """Return stored benchmark results in active terms with a Form column.
+
+    Terms can be deactivated without their results changing, so that
+    filter is applied here on every read rather than kept in the store,
+    from a live list of active terms rather than a cached one.
+    """
+    active = queries.read(_active_terms, connection, [int(districtID)],
+                          cache=False)
+    df_b = result_store.read(_benchmarks, districtID,
+                             parse_dates=["ResultDate"])
+    df_b = df_b[df_b.DistrictTermID.isin(active.DistrictTermID)].copy()
+    df_b["Form"] = df_b.TestName.str.extract(
+        r"Form.(.)", expand=False).fillna(" ")
+    return df_b
+
+
+def save_status(districtID, form, sheets):
+    """Write the status sheets to the Benchmark Status folder."""
+    label = "All Forms" if form == "All" else "Form " + form
+    file_name = "{} {} Benchmark Status {}.xlsx".format(
+        districts.lookup(districtID, connection_pool.setup_SQL).Name,
+        label,
         str(datetime.date.today()))
+    file_path = os.path.join(os.getcwd(), "Benchmark Status", file_name)
+    return sheet_writer.write_sheets(file_path, sheets)
+
 
-    if not os.path.exists("Benchmark Status"):
-        os.makedirs("Benchmark Status")
-    file_path = mal.path_to(file_name)
-    wb, excel = mal.get_excel(file_path)
-    ws_s = mal.get_sheet(wb, "Students")
-    mal.df_to_excel(df_s, ws_s)
-    # ws_b = mal.get_sheet(wb, "Benchmarks")
-    # mal.df_to_excel(df_b, ws_b)
-    for ws in wb.Worksheets:
-        ws.Cells.EntireColumn.AutoFit()
-    mal.excel_save_quit(wb, excel, file_name)
+def main(districtID, form):
+    """Extract Benchmark Status data and save as spreadsheet.
+
+    Pass form="All" to get one sheet for each of Forms A, B and C.
+    """
+    forms = _forms if form == "All" else [form]
+    sync_results(districtID)
+    connection = connection_pool.setup_SQL()
+    try:
+        # Live, so the report shows the roster as it is now.
+        df_s = queries.read(_students, connection, [int(districtID)],
+                            cache=False)
+        df_b = fetch_results(connection, districtID)
+    finally:
+        connection.close()
+    index = completion_index(df_b)
+    sheets = status_sheets(df_s, index, forms)
+    file_path = save_status(districtID, form, sheets)
     return (f"File created in {file_path}.")
+
+
+def watch(districtID, form, interval=3600, cycles=None):
+    """Keep a status workbook current, polling only for new results.
+
+    The roster is fetched once and kept in memory. Each poll syncs only
+    results updated since the last one into the local store, and the
+    workbook is rebuilt from the store only when something new came in.
+    Deleted results are looked for only once every _deleted_check, as
+    that means scanning the district's whole result history.
+
+    interval -- seconds to wait between polls
+    cycles -- stop after this many polls (default: run until stopped)
+    """
+    forms = _forms if form == "All" else [form]
+    sync_results(districtID)
+    connection = connection_pool.setup_SQL()
+    try:
+        # Live, as the workbook is meant to stay current all day.
+        df_s = queries.read(_students, connection, [int(districtID)],
+                            cache=False)
+        index = completion_index(fetch_results(connection, districtID))
+    finally:
+        connection.close()
+    file_path = save_status(districtID, form,
+                            status_sheets(df_s, index, forms))
+    print(f"File created in {file_path}.")
+    polls = 0
+    checked = time.monotonic()
+    while cycles is None or polls < cycles:
+        time.sleep(interval)
+        polls = polls + 1
+        check = time.monotonic() - checked >= _deleted_check
+        if check:
+            checked = time.monotonic()
+        since = sync_results(districtID, ids=None if check else False)
+        new = result_store.read(_benchmarks, districtID, since=since)
+        # A poll that looked for deleted results may have dropped some
+        # without bringing anything new, so it always rebuilds.
+        if new.empty and not check:
+            continue
+        # Between polls the connection goes back to the pool, which
+        # checks or replaces it before handing it out again.
+        connection = connection_pool.setup_SQL()
+        try:
+            index = completion_index(fetch_results(connection, districtID))
+        finally:
+            connection.close()
+        file_path = save_status(districtID, form,
+                                status_sheets(df_s, index, forms))
+        print(f"{len(new)} new results, file updated in {file_path}.")
+    return (f"File created in {file_path}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("districtID", type=int)
+    parser.add_argument("form", choices=_forms + ["All"])
+    parser.add_argument("--watch", type=float, metavar="MINUTES",
+                        help="keep polling for new results every MINUTES")
+    parser.add_argument("--refresh", action="store_true",
+                        help="ignore cached query results")
+    args = parser.parse_args()
+    query_cache.set_refresh(args.refresh)
+    if args.watch:
+        print(watch(args.districtID, args.form, interval=args.watch * 60))
+    else:
+        print(main(args.districtID, args.form))
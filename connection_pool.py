@@ -0,0 +1,212 @@
+"""Process-wide pool of database connections.
+
+Opening a connection to the production servers means a TLS and login
+handshake every time. The pool keeps connections open after use and
+hands them out again, so the GUI and batch workers stay warm from one
+extract to the next.
+
+setup_SQL and setup_FTP take the place of the functions of the same
+names in mal_data. The connections they return are used as usual;
+close() gives them back to the pool rather than closing them.
+"""
+import atexit
+import os
+import threading
+import time
+
+# Most connections, in use or idle, the pool opens to each server.
+_max_size = int(os.environ.get("EXTRACTOR_POOL_SIZE", 8))
+# Seconds an idle connection is kept before it is really closed.
+_idle_timeout = float(os.environ.get("EXTRACTOR_POOL_IDLE", 600))
+# Connections idle longer than this many seconds are checked before
+# being handed out again.
+_check_after = 30
+# Most seconds to wait for a connection when max_size are in use.
+_wait_timeout = float(os.environ.get("EXTRACTOR_POOL_WAIT", 300))
+
+# connect function -> its Pool
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PooledConnection(object):
+    """A pooled DB-API connection that goes back to its pool on close."""
+
+    def __init__(self, pool, raw):
+        """Wrap raw, a connection opened by pool."""
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        """Pass everything but close through to the real connection."""
+        if self._raw is None:
+            raise RuntimeError("Connection was returned to the pool.")
+        return getattr(self._raw, name)
+
+    def close(self):
+        """Give the connection back to the pool; safe to call twice."""
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.release(raw)
+
+
+class Pool(object):
+    """Connections made by one connect function, shared between callers."""
+
+    def __init__(self, connect, max_size=None, idle_timeout=None):
+        """Pool connections from connect, at most max_size at once."""
+        self.connect = connect
+        self.max_size = max_size or _max_size
+        self.idle_timeout = idle_timeout or _idle_timeout
+        # (connection, time it was returned), most recent last
+        self.idle = []
+        self.opened = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Return a healthy connection, opening one if none are idle.
+
+        Waits for one to be released if max_size are already open, for
+        at most timeout seconds (default: _wait_timeout), then raises
+        TimeoutError.
+        """
+        if timeout is None:
+            timeout = _wait_timeout
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                self.expire()
+                if self.idle:
+                    raw, returned = self.idle.pop()
+                    break
+                if self.opened < self.max_size:
+                    self.opened = self.opened + 1
+                    raw = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        "All {} pooled connections stayed in use for {}s."
+                        .format(self.max_size, timeout))
+                self.condition.wait(remaining)
+        if raw is not None:
+            if time.monotonic() - returned < _check_after or healthy(raw):
+                return PooledConnection(self, raw)
+            self.discard(raw)
+            return self.acquire(max(deadline - time.monotonic(), 0))
+        try:
+            raw = self.connect()
+        except Exception:
+            with self.condition:
+                self.opened = self.opened - 1
+                self.condition.notify()
+            raise
+        return PooledConnection(self, raw)
+
+    def release(self, raw):
+        """Take a connection back, dropping it if it can't be reset."""
+        try:
+            # Ends anything the last user left open.
+            raw.rollback()
+        except Exception:
+            self.discard(raw)
+            return
+        with self.condition:
+            self.idle.append((raw, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, raw):
+        """Close a connection for good and free its place in the pool."""
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self.condition:
+            self.opened = self.opened - 1
+            self.condition.notify()
+
+    def expire(self):
+        """Close connections idle longer than idle_timeout.
+
+        Call with self.condition held.
+        """
+        now = time.monotonic()
+        stale = [raw for raw, returned in self.idle
+                 if now - returned > self.idle_timeout]
+        self.idle = [(raw, returned) for raw, returned in self.idle
+                     if now - returned <= self.idle_timeout]
+        for raw in stale:
+            try:
+                raw.close()
+            except Exception:
+                pass
+            self.opened = self.opened - 1
+
+    def close(self):
+        """Close every idle connection."""
+        with self.condition:
+            for raw, returned in self.idle:
+                try:
+                    raw.close()
+                except Exception:
+                    pass
+                self.opened = self.opened - 1
+            self.idle = []
+            self.condition.notify_all()
+
+
+def healthy(raw):
+    """Return True if raw still answers a trivial query."""
+    try:
+        cursor = raw.cursor()
+        cursor.execute("select 1")
+        cursor.fetchall()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+def pool(connect):
+    """Return the process's Pool for connect, making it if need be."""
+    with _pools_lock:
+        if connect not in _pools:
+            _pools[connect] = Pool(connect)
+        return _pools[connect]
+
+
+def setup_SQL():
+    """Return a pooled connection like mal_data.setup_SQL's."""
+    # Imported here, so modules that only shape data can be imported,
+    # e.g. by tests, without the database drivers.
+    import mal_data
+    return pool(mal_data.setup_SQL).acquire()
+
+
+def setup_FTP():
+    """Return a pooled connection like mal_data.setup_FTP's."""
+    import mal_data
+    return pool(mal_data.setup_FTP).acquire()
+
+
+def warm(connect=None):
+    """Open a connection now and leave it idle, e.g. at startup.
+
+    connect -- setup_SQL or setup_FTP (default: both)
+    """
+    for setup in [connect] if connect else [setup_SQL, setup_FTP]:
+        setup().close()
+
+
+@atexit.register
+def close_all():
+    """Close every idle connection in every pool."""
+    with _pools_lock:
+        for each in _pools.values():
+            each.close()
+
+
+if hasattr(os, "register_at_fork"):
+    # A forked batch worker must open its own connections, not share the
+    # parent's sockets.
+    os.register_at_fork(after_in_child=_pools.clear)
@@ -0,0 +1,102 @@
+"""District demographics cache shared by the PARCC and Benchmark extracts.
+
+Students' gender, race and programs rarely change, so they are fetched
+for the whole district in one query and kept on disk for a while rather
+than re-queried on every extract.
+"""
+import datetime as dt
+import os
+import os.path
+import pandas as pd
+import queries
+import query_cache
+
+_cache_dir = os.path.join(os.getcwd(), "Cache", "Demographics")
+_ttl = dt.timedelta(days=7)
+
+# One row per student and program the student is in, or one row with no
+# Program for a student in none. Names are never joined into one string,
+# so no character in them can split a program in two.
+_students = queries.register("demographics.students", """
+declare @district int = ?
+
+select s.StudentID, g.Name as Gender, r.Name as Race, p.Name as Program
+from Student s with (nolock)
+left join Gender g with (nolock) on g.GenderID = s.GenderID
+left join Race r with (nolock) on r.RaceID = s.RaceID
+left join (StudentProgram sp with (nolock)
+           join Program p with (nolock) on p.ProgramID = sp.ProgramID
+           and p.DistrictID = @district)
+on sp.StudentID = s.StudentID
+where s.DistrictID = @district
+""")
+
+
+def cache_path(districtID):
+    """Return where a district's demographics are cached.
+
+    The name carries the query's digest, so a copy fetched by an older
+    query is never read back.
+    """
+    return os.path.join(_cache_dir, "{}-{}.pkl.gz".format(
+        int(districtID), _students.digest))
+
+
+def district_demographics(districtID, connect, ttl=None, refresh=False):
+    """Return every student in the district with Gender, Race, Program.
+
+    A student has one row per program, or one with no Program if in none.
+
+    Reads the cached copy if it is younger than ttl, otherwise queries
+    the database through a connection from connect and re-caches it.
+
+    ttl -- how old a cached copy may be (default: 7 days)
+    refresh -- ignore any cached copy, as does query_cache's refresh
+    """
+    if ttl is None:
+        ttl = _ttl
+    path = cache_path(districtID)
+    refresh = refresh or query_cache.refreshing()
+    if not refresh and os.path.exists(path):
+        age = dt.datetime.now() - dt.datetime.fromtimestamp(
+            os.path.getmtime(path))
+        if age < ttl:
+            return pd.read_pickle(path)
+    cnxn = connect()
+    try:
+        df = queries.read(_students, cnxn, [int(districtID)], cache=False)
+    finally:
+        cnxn.close()
+    os.makedirs(_cache_dir, exist_ok=True)
+    # Batch runs may be caching the same district from two processes, so
+    # write beside the cache and swap it in whole.
+    partial = "{}.{}.tmp".format(path, os.getpid())
+    df.to_pickle(partial, compression="gzip")
+    os.replace(partial, path)
+    return df
+
+
+def demographic_sheets(df, students=None):
+    """Return the Gender, Race and Program sheets from demographics.
+
+    Gender and Race have one row per student, Program one per student
+    and program, the same layout as the old per-attribute queries.
+
+    students -- only keep these StudentIDs, e.g. the students that
+        appear in the score results
+    """
+    if students is not None:
+        df = df[df.StudentID.isin(students)]
+    people = df.drop_duplicates('StudentID')
+    return {
+        'Gender': people[['StudentID', 'Gender']].dropna(),
+        'Race': people[['StudentID', 'Race']].dropna(),
+        'Program': df[['StudentID', 'Program']].dropna(),
+    }
+
+
+def collect_students(frames, students):
+    """Pass frames through, adding each frame's StudentIDs to students."""
+    for df in frames:
+        students.update(df.StudentID)
+        yield df
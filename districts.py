@@ -0,0 +1,84 @@
+"""District metadata, looked up once and remembered.
+
+Every extract needs the district's name, and the Benchmark extract also
+needs to know which state test the district takes. One query fetches
+all of it; the answer is kept in memory for the rest of the run and on
+disk for later runs and the other processes of a batch.
+"""
+import datetime as dt
+import json
+import os
+import os.path
+import time
+from collections import namedtuple
+import queries
+import query_cache
+
+_cache_dir = os.path.join(os.getcwd(), "Cache", "Districts")
+_ttl = dt.timedelta(days=30)
+
+# State test and its achievement level setting, by StateID. Districts in
+# any other state take _default_state_test.
+_state_tests = {
+    49: ('PARCC', 217),  # New Jersey
+}
+_default_state_test = ('PSSA', 109)
+
+District = namedtuple("District", [
+    "DistrictID", "Name", "StateID", "StateTest", "AchievementLevel"])
+
+_district = queries.register("districts.metadata", """
+select DistrictID, Name, StateID from District with (nolock)
+where DistrictID = ?""")
+
+# DistrictID -> District, for this process.
+_memo = {}
+
+
+def state_test(stateID):
+    """Return the (state test, achievement level setting) for a state."""
+    return _state_tests.get(stateID, _default_state_test)
+
+
+def cache_path(districtID):
+    """Return where a district's metadata is cached."""
+    return os.path.join(_cache_dir, "{}.json".format(int(districtID)))
+
+
+def lookup(districtID, connect):
+    """Return the District for districtID.
+
+    Looks in memory, then on disk, then queries the database through a
+    connection from connect. Cached copies older than _ttl, and any
+    while query_cache is refreshing, are looked up again.
+    """
+    districtID = int(districtID)
+    if districtID in _memo and not query_cache.refreshing():
+        return _memo[districtID]
+    path = cache_path(districtID)
+    if not query_cache.refreshing() and os.path.exists(path) and (
+            time.time() - os.path.getmtime(path) < _ttl.total_seconds()):
+        with open(path, 'r') as file:
+            row = json.load(file)
+    else:
+        cnxn = connect()
+        try:
+            df = queries.read(_district, cnxn, [districtID], cache=False)
+        finally:
+            cnxn.close()
+        if df.empty:
+            raise ValueError("No district with ID {}.".format(districtID))
+        row = {'Name': str(df.at[0, 'Name']),
+               'StateID': int(df.at[0, 'StateID'])}
+        os.makedirs(_cache_dir, exist_ok=True)
+        # Batch workers may be caching the same district at once.
+        partial = "{}.{}.tmp".format(path, os.getpid())
+        with open(partial, 'w') as file:
+            json.dump(row, file)
+        os.replace(partial, path)
+    # The state test is mapped here rather than cached, so changes to
+    # _state_tests apply at once.
+    district = District(districtID, row['Name'], row['StateID'],
+                        *state_test(row['StateID']))
+    _memo[districtID] = district
+    return district
@@ -2,690 +2,564 @@
 import pandas as pd
 import os.path
 import datetime as dt
-import mal_data as mal
-
-
-def parcc_or_pssa(cnxn, districtID):
-    """Return a touple of fill-in values based on the district's State."""
-    df = pd.read_sql("""select StateID from District with (nolock)
-                     WHERE DistrictID = """+str(districtID), cnxn)
-    if df["StateID"][0] == 49:
-        print("New Jersey District, StateID:", df["StateID"][0])
-        return 'PARCC', 217
-    print("Non-New Jersey District, StateID:", df["StateID"][0])
-    return 'PSSA', 109
-
-
-def clean_term(row):
-    """Set term name to 2016-17 or 2017-18."""
-    if '18' in row.DistrictTerm:
-        row.DistrictTerm = '2017-18'
-    elif '16' in row.DistrictTerm:
-        row.DistrictTerm = '2016-17'
-    else:
-        if row.ResultDate > dt.datetime(2017, 7, 30):
-            row.DistrictTerm = '2017-18'
-        elif row.ResultDate > dt.datetime(2016, 7, 30):
-            row.DistrictTerm = '2016-17'
-    return row.DistrictTerm
-
-
-def clean_term2(row):
-    """Set term name to 2016-17 or 2017-18."""
-    if '18' in row.TermName:
-        row.TermName = '2017-18'
-    elif '16' in row.TermName:
-        row.TermName = '2016-17'
-    else:
-        if row.MostRecentDate > dt.datetime(2017, 7, 30):
-            row.TermName = '2017-18'
-        elif row.MostRecentDate > dt.datetime(2016, 7, 30):
-            row.TermName = '2016-17'
-    return row.TermName
-
-
-def extract(districtID):
-    """Create the data extract."""
-    districtID = str(districtID)
-    cnxn = mal.setup_FTP()
-    box = pd.read_sql(
-        "select Name from District with (nolock) WHERE DistrictID = \'"
-        + districtID + "\'", cnxn)
-    dname = box.at[0, 'Name']
-    state_test, achievement_level = parcc_or_pssa(cnxn, districtID)
+import connection_pool
+import demographics
+import districts
+import queries
+import query_runner
+import result_store
+import sheet_writer
+
+# Compact dtypes for the columns the queries below share, applied as
+# soon as rows are fetched; see queries.compact. A query ignores the
+# columns it doesn't return.
+_schema = dict(
+    [(column, 'category') for column in [
+        'DistrictTerm', 'TermName', 'TestName', 'Test Name', 'Subject',
+        'Grade', 'School', 'SchoolName', 'TeacherCode', 'TeacherFirstName',
+        'TeacherLastName', 'ClassName', 'StudentCode', 'StudentFirstName',
+        'StudentLastName', 'AchievementLevel', 'Gender', 'Race', 'Number',
+        'Program', 'Kind', 'Name']]
+    + [(column, 'integer') for column in [
+        'TestResultID', 'UserID', 'ClassID', 'StudentID', 'SchoolID',
+        'VirtualQuestionID', 'PointsEarned', 'PointsPossible',
+        'Points Earned', 'Points Possible', 'TotalPointsEarned',
+        'TotalPointsPossible', 'ScaledScore']])
+
+# LinkIt Form results and total points, one row per test result.
+# Synced into the local result store, like the other row-level queries.
+_benchmarks = queries.register("benchmark.benchmarks", """
+declare @since datetime = ?
+declare @districtid int, @resultdate datetime
+set @districtid=?
+set @resultdate='2016-08-01'
+
+---local assessment---
+select tr.TestResultID, tr.UpdatedDate,
+tr.UpdatedDate as [ResultDate], dt.name as DistrictTerm,
+vt.name as TestName, sub.name as Subject, gr.name as Grade,
+sch.Name as School, u.UserID, u.code as TeacherCode, u.NameFirst
+as TeacherFirstName, u.NameLast as TeacherLastName, c.ClassID,
+c.Name as ClassName, s.StudentID, s.code as StudentCode,
+s.FirstName as StudentFirstName, s.LastName as StudentLastName,
+trs.ScoreRaw as TotalPointsEarned, trs.PointsPossible as
+TotalPointsPossible from testresultscore trs With (nolock)
+join testresult tr With (nolock) on
+tr.testresultid=trs.testresultid
+join virtualtest vt With (nolock) on
+vt.VirtualTestID=tr.VirtualTestID
+join bank b With (nolock) on b.BankID =vt.bankid
+join subject sub With (nolock) on sub.subjectid=b.SubjectID
+join grade gr With (nolock) on gr.GradeID=sub.GradeID
+join student s With (nolock) on s.studentid=tr.StudentID
+join school sch With (nolock) on sch.SchoolID=tr.SchoolID
+join class c With (nolock) on c.classid=tr.classid
+join DistrictTerm dt With (nolock) on
+dt.DistrictTermID=c.DistrictTermID
+join [user] u With (nolock) on u.userid=tr.userid
+where dt.DistrictID=@districtid and tr.ResultDate>@resultdate
+and tr.UpdatedDate > @since
+and vt.Name like '%LinkIt%form%'
+and not (vt.Name like '%Link%it%form%CR%'
+or vt.Name like '%Retake%'
+or vt.Name like '%luppino%')
+order by tr.UpdatedDate desc""", _schema)
+
+# State test scaled scores. Formatted with the district, the state test
+# name and its achievement level setting.
+_state_scores = queries.register("benchmark.state_scores", """
+declare @since datetime = ?
+declare @districtid int, @resultdate datetime
+set @districtid=?
+set @resultdate='2016-08-01'
+
+select tr.TestResultID, tr.UpdatedDate,
+vt.Name as TestName, sub.name as Subject, gr.Name as
+Grade, sch.SchoolID, sch.name as SchoolName, s.StudentID, s.code
+as StudentCode, s.FirstName as StudentFirstName, s.LastName as
+StudentLastName, trs.ScoreScaled as ScaledScore,
+trs.AchievementLevel  from TestResultScore trs With (nolock)
+join testresult tr With (nolock) on
+tr.testresultid=trs.testresultid
+join virtualtest vt With (nolock) on
+vt.VirtualTestID=tr.VirtualTestID
+join bank b With (nolock) on b.BankID =vt.bankid
+join subject sub With (nolock) on sub.subjectid=b.SubjectID
+join grade gr With (nolock) on gr.GradeID=sub.GradeID
+join student s With (nolock) on s.studentid=tr.StudentID
+join school sch With (nolock) on sch.SchoolID=tr.SchoolID
+where sch.DistrictID=@districtid and vt.Name like ?
+and vt.achievementlevelsettingid=? and tr.UpdatedDate > @since""", _schema)
+
+# Banks of the state test practice forms we break down by demographic,
+# keyed by state test.
+_standards_banks = {
+    'PARCC': [
+        59164, 59163, 59075, 59089, 59076, 59091, 59077, 59090, 59079,
+        59092, 59081, 59093, 59084, 59094, 59085, 59095, 59086, 59096,
+        59074, 59088, 59087, 59098, 60246, 59123, 59134, 59124, 59135,
+        59125, 59136, 59126, 59137, 59127, 59138, 59128, 59139, 59129,
+        59140, 59130, 59141, 59131, 59133, 59132, 59142, 59171, 59170],
+    'PSSA': [
+        58520, 58522, 58523, 58524, 58525, 58526, 58527, 58528, 58529,
+        58530, 58531, 58532, 58667, 58668, 58669, 58670, 58671, 58672,
+        58922, 58923],
+}
+
+# Standards by ... sheets each state test gets. The old extract never
+# wrote PSSA's Standards by Program sheet, so PSSA clients still don't
+# get one until that is decided on its own.
+_standards_cuts = {
+    'PARCC': ['Gender', 'Race', 'Program'],
+    'PSSA': ['Gender', 'Race'],
+}
+
+# Standard points per test result on the banks above, with the
+# student's gender and race attached. Formatted with a state's banks.
+_demographic_points = """declare @district int
+set @district=?
+
+select tr.TestResultID, sch.Name as 'School', vt.Name as 'Test Name',
+g.Name as 'Gender', r.Name as 'Race', ms.Number,
+sum(a.PointsEarned) as 'Points Earned',
+sum(a.PointsPossible) as 'Points Possible'
+from VirtualTest vt with (nolock)
+join TestResult tr with (nolock) on tr.VirtualTestID = vt.VirtualTestID
+join School sch with (nolock) on sch.SchoolID = tr.SchoolID
+join Student s with (nolock) on s.StudentID = tr.StudentID
+left join Gender g with (nolock) on s.GenderID = g.GenderID
+left join Race r with (nolock) on s.RaceID = r.RaceID
+join VirtualQuestion vq with (nolock) on
+vq.VirtualTestID = vt.VirtualTestID
+join VirtualQuestionStateStandard vqss with (nolock) on
+vqss.VirtualQuestionID = vq.VirtualQuestionID
+join MasterStandard ms with (nolock) on
+ms.MasterStandardID = vqss.StateStandardID
+join Answer a with (nolock) on a.TestResultID = tr.TestResultID
+and a.VirtualQuestionID = vq.VirtualQuestionID
+where vt.BankID in ({}) and s.DistrictID = @district
+group by tr.TestResultID, sch.Name, vt.Name, g.Name, r.Name, ms.Number
+"""
+
+# Programs attached to each test result counted in _demographic_points.
+_result_programs = """declare @district int
+set @district=?
+
+select tr.TestResultID, p.Name as 'Program'
+from TestResult tr with (nolock)
+join VirtualTest vt with (nolock) on tr.VirtualTestID = vt.VirtualTestID
+join Student s with (nolock) on s.StudentID = tr.StudentID
+join TestResultProgram trp with (nolock) on
+trp.TestResultID = tr.TestResultID
+join Program p with (nolock) on trp.ProgramID = p.ProgramID
+where vt.BankID in ({}) and s.DistrictID = @district
+"""
+
+# The bank IDs are fixed per state test, so they are written into the
+# query text and each state test gets its own registered query.
+_standards_queries = {
+    test: (queries.register(
+               "benchmark.demographic_points." + test,
+               _demographic_points.format(
+                   ",".join(str(bank) for bank in banks)), _schema),
+           queries.register(
+               "benchmark.result_programs." + test,
+               _result_programs.format(
+                   ",".join(str(bank) for bank in banks)), _schema))
+    for test, banks in _standards_banks.items()}
+
+# Keys the Standards and Skills sheets are summed over.
+_answer_keys = [
+    'TermName', 'TestName', 'Subject', 'Grade', 'SchoolName',
+    'UserID', 'TeacherCode', 'TeacherFirstName', 'TeacherLastName',
+    'ClassID', 'ClassName']
+
+# Every LinkIt Form answer in the district since @resultdate, one row
+# per answer. Shared by the Standards and Skills sheets. As before,
+# answers on a test with no bank, subject or grade are left out, while
+# a missing school, class or term only leaves its name empty.
+_answer_facts = queries.register("benchmark.answer_facts", """
+declare @since datetime = ?
+declare @districtid int, @resultdate datetime
+set @districtid=?
+set @resultdate='2017-08-01'
+SET NOCOUNT ON
+
+select tr.TestResultID, tr.UpdatedDate, dt.Name as TermName,
+vt.Name as TestName, sb.Name as Subject, g.Name as Grade,
+sc.Name as SchoolName, tr.UserID, u.Code as TeacherCode,
+u.NameFirst as TeacherFirstName, u.NameLast as TeacherLastName,
+tr.ClassID, c.Name as ClassName, a.VirtualQuestionID,
+a.PointsEarned, a.PointsPossible
+from TestResult tr with (nolock)
+join [User] u with (nolock) on tr.UserID = u.UserID
+join VirtualTest vt with (nolock) on tr.VirtualTestID = vt.VirtualTestID
+join Bank b with (nolock) on vt.BankID = b.BankID
+join Subject sb with (nolock) on b.SubjectID = sb.SubjectID
+join Grade g with (nolock) on sb.GradeID = g.GradeID
+left join School sc with (nolock) on tr.SchoolID = sc.SchoolID
+left join Class c with (nolock) on tr.ClassID = c.ClassID
+left join DistrictTerm dt with (nolock) on
+c.DistrictTermID = dt.DistrictTermID
+join Answer a with (nolock) on a.TestResultID = tr.TestResultID
+join VirtualQuestion vq with (nolock) on
+a.VirtualQuestionID = vq.VirtualQuestionID
+join QTIItem q with (nolock) on vq.QTIItemID = q.QTIItemID
+where u.DistrictID = @districtid and tr.ResultDate > @resultdate
+and tr.UpdatedDate > @since
+and vt.Name like '%linkit%form%' and not (vt.Name like
+'%Link%it%form%CR%' or vt.Name like '%Retake%')
+""", _schema)
+
+# Standard numbers and skill names for every question on the tests the
+# district took, so _answer_facts can be mapped to either locally.
+_question_map = queries.register("benchmark.question_map", """
+declare @districtid int, @resultdate datetime
+set @districtid=?
+set @resultdate='2017-08-01'
+SET NOCOUNT ON;
+
+with tests as (
+select distinct tr.VirtualTestID
+from TestResult tr with (nolock)
+join [User] u with (nolock) on tr.UserID = u.UserID
+where u.DistrictID = @districtid and tr.ResultDate > @resultdate)
+
+select vq.VirtualQuestionID, 'Standard' as Kind, ms.Number as Name
+from VirtualQuestion vq with (nolock)
+join tests on tests.VirtualTestID = vq.VirtualTestID
+join VirtualQuestionStateStandard vqss with (nolock) on
+vq.VirtualQuestionID = vqss.VirtualQuestionID
+join MasterStandard ms with (nolock) on
+vqss.StateStandardID = ms.MasterStandardID
+union all
+select vq.VirtualQuestionID, 'Skill' as Kind, lo.Name
+from VirtualQuestion vq with (nolock)
+join tests on tests.VirtualTestID = vq.VirtualTestID
+join VirtualQuestionLessonOne vql with (nolock) on
+vq.VirtualQuestionID = vql.VirtualQuestionID
+join LessonOne lo with (nolock) on vql.LessonOneID = lo.LessonOneID
+""", _schema)
+
+
+def by_unique(values, transform):
+    """Run a vectorized transform once per distinct value and spread it.
+
+    Term names, test names and days repeat on thousands of rows, so this
+    turns most transforms here into a few hundred string operations.
+    """
+    codes, uniques = pd.factorize(values)
+    result = transform(pd.Series(uniques)).to_numpy()
+    spread = pd.Series(result[codes], index=values.index, dtype=object)
+    return spread.where(codes != -1)
+
+
+# A school year written out, e.g. 2017-18, 17-18 or 2017-2018.
+_school_year = (r"(?i)(?<!grade )(?<!gr )\b(20\d{2}|\d{2})\s*-\s*"
+                r"(20\d{2}|\d{2})\b")
+
+
+def term_calendar(first_year, last_year):
+    """Return a table of school years and the dates they start after.
+
+    A school year named 2017-18 holds every result after July 30, 2017.
+    """
+    years = range(first_year, last_year + 1)
+    return pd.DataFrame({
+        "Start": [dt.datetime(year, 7, 30) for year in years],
+        "Term": ['{}-{:02d}'.format(year, (year + 1) % 100)
+                 for year in years]})
+
+
+def terms_from_names(names):
+    """Return the school year spelled out in each term name, if any.
+
+    Matches names like "2017-18", "17-18" or "2017-2018", where the
+    second year follows the first. A range right after "Grade", as in
+    "Grade 10-11 Review", is a grade span rather than a year.
+    """
+    return by_unique(names, _terms_from_names)
+
+
+def _terms_from_names(names):
+    """Do the work of terms_from_names on already-unique names."""
+    years = names.str.extract(_school_year)
+    start = pd.to_numeric(years[0].str[-2:]) % 100
+    end = pd.to_numeric(years[1].str[-2:]) % 100
+    valid = (start + 1) % 100 == end
+    terms = ("20" + start.astype("Int64").astype(str).str.zfill(2)
+             + "-" + end.astype("Int64").astype(str).str.zfill(2))
+    return terms.where(valid)
+
+
+def terms_from_dates(dates):
+    """Look up the school year each date falls in."""
+    known = dates.dropna()
+    if known.empty:
+        return pd.Series(None, index=dates.index, dtype=object)
+    calendar = term_calendar(known.min().year - 1, known.max().year)
+    lookup = pd.merge_asof(
+        known.sort_values().rename("Date").rename_axis("row").reset_index(),
+        calendar, left_on="Date", right_on="Start",
+        allow_exact_matches=False)
+    return lookup.set_index("row")["Term"].reindex(dates.index)
+
+
+def clean_terms(names, dates):
+    """Set term names to their school year, e.g. 2017-18.
+
+    The year written in the term name wins; otherwise the school year is
+    taken from the date. Names with neither are left as they are.
+    """
+    return (terms_from_names(names)
+            .fillna(terms_from_dates(dates))
+            .fillna(names))
+
+
+def form_letters(names):
+    """Return the letter after "Form " in each test name, or a space."""
+    return by_unique(names, lambda unique: unique.str.extract(
+        r"Form.(.)", expand=False)).fillna(" ")
+
+
+def short_dates(dates):
+    """Format dates as M/D/YYYY without leading zeros."""
+    return by_unique(dates.dt.normalize(), lambda unique: unique.dt.strftime(
+        "%m/%d/%Y").str.replace(r"\b0", "", regex=True))
+
+
+def points_by_question(facts, questions, kind, column):
+    """Sum answer points per class, test and standard or skill.
+
+    facts -- answer rows from _answer_facts
+    questions -- question mappings from _question_map
+    kind -- 'Standard' or 'Skill', the mapping to sum over
+    column -- name to give the mapped standard or skill column
+    """
+    mapping = questions.loc[questions.Kind == kind,
+                            ['VirtualQuestionID', 'Name']]
+    rows = facts.merge(mapping, on='VirtualQuestionID')
+    rows = rows.rename(columns={'Name': column})
+    return rows.groupby(_answer_keys + [column], dropna=False,
+                        observed=True).agg(
+        EarliestDate=('UpdatedDate', 'min'),
+        MostRecentDate=('UpdatedDate', 'max'),
+        TotalPointsEarned=('PointsEarned', 'sum'),
+        TotalPointsPossible=('PointsPossible', 'sum')).reset_index()
+
+
+def standards_by(points, column):
+    """Sum standard points per school, test and demographic column.
+
+    Results with no value in column are left out, as the server-side
+    INNER JOINs used to do.
+    """
+    keys = ['School', 'Test Name', column, 'Number']
+    box = points.groupby(keys, observed=True)[
+        ['Points Earned', 'Points Possible']].sum()
+    box = box.reset_index()
+    return box.sort_values(['School', 'Test Name', 'Number', column],
+                           ignore_index=True)
+
+
+def merge_points(parts, column):
+    """Combine points_by_question results from several chunks of facts."""
+    if not parts:
+        return pd.DataFrame(columns=_answer_keys + [column])
+    points = pd.concat(parts, ignore_index=True)
+    return points.groupby(_answer_keys + [column], dropna=False,
+                          observed=True).agg(
+        EarliestDate=('EarliestDate', 'min'),
+        MostRecentDate=('MostRecentDate', 'max'),
+        TotalPointsEarned=('TotalPointsEarned', 'sum'),
+        TotalPointsPossible=('TotalPointsPossible', 'sum')).reset_index()
+
+
+# Columns of the Linkit Benchmarks sheet, and of the PARCC or PSSA one.
+_benchmark_columns = [
+    'ResultDate', 'DistrictTerm',
+    'TestName', 'Subject', 'Grade', 'Form', 'School',
+    'UserID', 'TeacherCode', 'TeacherFirstName', 'TeacherLastName',
+    'ClassID', 'ClassName',
+    'StudentID', 'StudentCode', 'StudentFirstName', 'StudentLastName',
+    'TotalPointsEarned', 'TotalPointsPossible']
+_state_score_columns = [
+    'Year', 'TestName', 'Subject', 'Grade', 'SchoolID', 'SchoolName',
+    'StudentID', 'StudentCode', 'StudentFirstName', 'StudentLastName',
+    'ScaledScore', 'AchievementLevel']
+
+
+def benchmark_rows(box):
+    """Shape LinkIt Form results for the Linkit Benchmarks sheet."""
+    box['Form'] = form_letters(box.TestName)
+    box['DistrictTerm'] = clean_terms(box.DistrictTerm, box.ResultDate)
+    box['ResultDate'] = short_dates(box.ResultDate)
+    return box[_benchmark_columns]
+
+
+def state_score_rows(box2):
+    """Shape state test scores for the PARCC or PSSA sheet."""
+    box2['Year'] = box2.TestName.str[5:9]
+    return box2[_state_score_columns]
+
+
+def question_rows(box, column):
+    """Shape points_by_question output for the Standards/Skills sheets."""
+    box['Form'] = form_letters(box.TestName)
+    box['TermName'] = clean_terms(box.TermName, box.MostRecentDate)
+    return box[[
+        'TermName', 'TestName', 'Subject', 'Grade', 'Form', 'SchoolName',
+        'UserID', 'TeacherCode', 'TeacherFirstName', 'TeacherLastName',
+        'ClassID', 'ClassName', column,
+        'TotalPointsEarned', 'TotalPointsPossible']]
+
+
+def extract(districtID, max_workers=None, chunksize=None,
+            scored_only=False, delta_only=False):
+    """Create the data extract.
+
+    The row-level results are first synced into the local result store,
+    fetching only what changed since the last run, then read from there.
+
+    max_workers -- most queries to run against the database at once
+    chunksize -- stream the row-level results this many rows at a time,
+        keeping memory use flat (default: result_store.chunk_rows());
+        0 reads them whole
+    scored_only -- only list demographics for students with results
+    delta_only -- write only the benchmark and state test rows that are
+        new or changed since the last delta export, to a separate Delta
+        file
+    """
+    districtID = int(districtID)
+    chunksize = result_store.chunk_rows(chunksize)
+    connect = connection_pool.setup_FTP
+    district = districts.lookup(districtID, connect)
+    dname = district.Name
+    state_test = district.StateTest
+    achievement_level = district.AchievementLevel
+    print("{} District, StateID: {}".format(state_test, district.StateID))
     extracts = os.path.join(os.getcwd(), "Extracts")
-    if not os.path.exists(extracts):
-        os.makedirs(extracts)
-    n = os.path.join(extracts, dname + ' Form B Data 2017-18.xlsx')
-    writer = pd.ExcelWriter(n)
-
-    box = pd.read_sql(
-        """declare @districtid int, @resultdate datetime
-        set @districtid="""+districtID+"""
-        set @resultdate='2016-08-01'
-
-        ---local assessment---
-        select tr.UpdatedDate as [ResultDate], dt.name as DistrictTerm,
-        vt.name as TestName, sub.name as Subject, gr.name as Grade,
-        sch.Name as School, u.UserID, u.code as TeacherCode, u.NameFirst
-        as TeacherFirstName, u.NameLast as TeacherLastName, c.ClassID,
-        c.Name as ClassName, s.StudentID, s.code as StudentCode,
-        s.FirstName as StudentFirstName, s.LastName as StudentLastName,
-        trs.ScoreRaw as TotalPointsEarned, trs.PointsPossible as
-        TotalPointsPossible from testresultscore trs With (nolock)
-        join testresult tr With (nolock) on
-        tr.testresultid=trs.testresultid
-        join virtualtest vt With (nolock) on
-        vt.VirtualTestID=tr.VirtualTestID
-        join bank b With (nolock) on b.BankID =vt.bankid
-        join subject sub With (nolock) on sub.subjectid=b.SubjectID
-        join grade gr With (nolock) on gr.GradeID=sub.GradeID
-        join student s With (nolock) on s.studentid=tr.StudentID
-        join school sch With (nolock) on sch.SchoolID=tr.SchoolID
-        join class c With (nolock) on c.classid=tr.classid
-        join DistrictTerm dt With (nolock) on
-        dt.DistrictTermID=c.DistrictTermID
-        join [user] u With (nolock) on u.userid=tr.userid
-        where dt.DistrictID=@districtid and tr.ResultDate>@resultdate
-        and vt.Name like '%LinkIt%form%'
-        and not (vt.Name like '%Link%it%form%CR%'
-        or vt.Name like '%Retake%'
-        or vt.Name like '%luppino%')
-        order by tr.UpdatedDate desc""", cnxn, parse_dates=['ResultDate'])
-
-    if(not box.empty):
-        box['Form'] = box.apply(
-            lambda row: row.TestName[row.TestName.find("Form") + 5] if
-            ("Form" in row.TestName) else " ", axis=1)
-        box['DistrictTerm'] = box.apply(lambda row: clean_term(row),
-                                        axis=1)
-        box['ResultDate'] = box.apply(
-            lambda row: '{}/{}/{}'.format(
-                row.ResultDate.month,
-                row.ResultDate.day,
-                row.ResultDate.year),
-            axis=1)
-        box = box[[
-            'ResultDate', 'DistrictTerm',
-            'TestName', 'Subject', 'Grade', 'Form', 'School',
-            'UserID', 'TeacherCode', 'TeacherFirstName', 'TeacherLastName',
-            'ClassID', 'ClassName',
-            'StudentID', 'StudentCode', 'StudentFirstName', 'StudentLastName',
-            'TotalPointsEarned', 'TotalPointsPossible']]
-        box.to_excel(writer, sheet_name='Linkit Benchmarks', index=False)
-    box2 = pd.read_sql(
-        """declare @districtid int, @resultdate datetime
-        set @districtid="""+districtID+"""
-        set @resultdate='2016-08-01'
-
-        select vt.Name as TestName, sub.name as Subject, gr.Name as
-        Grade, sch.SchoolID, sch.name as SchoolName, s.StudentID, s.code
-        as StudentCode, s.FirstName as StudentFirstName, s.LastName as
-        StudentLastName, trs.ScoreScaled as ScaledScore,
-        trs.AchievementLevel  from TestResultScore trs With (nolock)
-        join testresult tr With (nolock) on
-        tr.testresultid=trs.testresultid
-        join virtualtest vt With (nolock) on
-        vt.VirtualTestID=tr.VirtualTestID
-        join bank b With (nolock) on b.BankID =vt.bankid
-        join subject sub With (nolock) on sub.subjectid=b.SubjectID
-        join grade gr With (nolock) on gr.GradeID=sub.GradeID
-        join student s With (nolock) on s.studentid=tr.StudentID
-        join school sch With (nolock) on sch.SchoolID=tr.SchoolID
-        where sch.DistrictID=@districtid and vt.Name like '20%-20%"""
-        + state_test + """%' and vt.achievementlevelsettingid="""
-        + str(achievement_level), cnxn)
-
-    box2['Year'] = box2.apply(lambda row: row.TestName[5:9], axis=1)
-    box2 = box2[[
-        'Year', 'TestName', 'Subject', 'Grade', 'SchoolID', 'SchoolName',
-        'StudentID', 'StudentCode', 'StudentFirstName', 'StudentLastName',
-        'ScaledScore', 'AchievementLevel']]
-    box2.to_excel(writer, sheet_name=state_test, index=False)
-    cnxn = mal.setup_FTP()
-
-    # Standards
-
-    box3 = pd.read_sql(
-        """declare @districtid int, @resultdate datetime
-        set @districtid="""+districtID+"""
-        set @resultdate='2017-08-01'
-
-        ----Standards---
-        DECLARE @testdata3 TABLE (ID int IDENTITY(1,1), VirtualTestID
-        INT, TestName VARCHAR(1000), Subject VARCHAR(1000),
-        Grade VARCHAR(25), SchoolID INT, SchoolName VARCHAR(1000),
-        TestResultID INT, UserID INT, TeacherCode VARCHAR(1000),
-        TeacherFirstName VARCHAR (100), TeacherLastName VARCHAR(1000),
-        ClassID INT, ClassName VARCHAR(1000), TermName VARCHAR(1000),
-        updatedate datetime)
-
-        DECLARE @testdata3a TABLE (ID int IDENTITY(1,1), StandardNbr
-        VARCHAR(1200), TotalPointsEarned INT, TotalPointsPossible INT,
-        ClassID INT, UserID INT, VirtualTestID INT, TestResultID INT)
-        SET NOCOUNT ON
-
-        INSERT INTO @testdata3 (VirtualTestID, SchoolID, UserID,
-        ClassID, TestResultID, updatedate)
-        SELECT tr.VirtualTestID, tr.SchoolID, tr.UserID, tr.ClassID,
-        tr.TestResultID, tr.UpdatedDate
-        FROM TestResult AS tr INNER JOIN [User] AS u ON
-        tr.UserID = u.UserID
-        WHERE    (u.DistrictID = @DistrictID)
-        AND (tr.ResultDate > @resultdate)
-
-        SET NOCOUNT ON
-        UPDATE @testdata3
-        SET SchoolName = sc.Name
-        FROM @testdata3 AS td INNER JOIN
-        School AS sc ON td.SchoolID = sc.SchoolID
-
-        SET NOCOUNT ON
-        UPDATE @testdata3
-        SET Subject = sb.Name, Grade = g.Name, TestName = vt.Name
-        FROM @testdata3 AS td INNER JOIN
-        VirtualTest AS vt ON td.VirtualTestID = vt.VirtualTestID
-        INNER JOIN
-        Bank AS b ON vt.BankID = b.BankID INNER JOIN
-        Subject AS sb ON b.SubjectID = sb.SubjectID INNER JOIN
-        Grade AS g ON sb.GradeID = g.GradeID
-
-        SET NOCOUNT ON
-        UPDATE @testdata3
-        SET ClassName = c.Name, TermName = dt.Name
-        FROM @testdata3 AS td INNER JOIN
-        Class AS c ON td.ClassID = c.ClassID INNER JOIN
-        DistrictTerm AS dt ON c.DistrictTermID = dt.DistrictTermID
-
-        SET NOCOUNT ON
-        UPDATE @testdata3
-        SET TeacherCode = u.Code, TeacherFirstName = u.NameFirst,
-        TeacherLastName = u.NameLast
-        FROM @testdata3 AS td INNER JOIN
-        [User] AS u ON td.UserID = u.UserID
-
-
-        SET NOCOUNT ON
-        INSERT INTO @testdata3a (StandardNbr, ClassID, UserID, VirtualTestID,
-        TotalPointsEarned, TotalPointsPossible, TestResultID)
-        SELECT ms.Number, td.ClassID, td.UserID, td.VirtualTestID,
-        a.PointsEarned, a.PointsPossible, td.TestResultID
-        FROM @testdata3 AS td INNER JOIN
-        Answer AS a ON td.TestResultID = a.TestResultID INNER JOIN
-        VirtualQuestion AS vq ON a.VirtualQuestionID = vq.VirtualQuestionID
-        INNER JOIN QTIItem AS q ON vq.QTIItemID = q.QTIItemID INNER JOIN
-        VirtualQuestionStateStandard AS vqss ON vq.VirtualQuestionID =
-        vqss.VirtualQuestionID INNER JOIN
-        MasterStandard AS ms ON vqss.StateStandardID =
-        ms.MasterStandardID
-
-        SELECT min(td.updatedate) as EarliestDate,max(td.updatedate) as
-        MostRecentDate, td.TermName, td.TestName, td.Subject, td.Grade,
-        td.SchoolName, td.UserID, td.TeacherCode, td.TeacherFirstName,
-        td.TeacherLastName, td.ClassID, td.ClassName,  tda.StandardNbr,
-        SUM(tda.TotalPointsEarned)As TotalPointsEarned,
-        SUM(tda.TotalPointsPossible) AS TotalPointsPossible
-        FROM @testdata3 AS td INNER JOIN
-        @testdata3a AS tda ON td.TestResultID = tda.TestResultID
-        where td.TestName like '%linkit%form%' and not (td.TestName like
-        '%Link%it%form%CR%' or td.TestName like '%Retake%')
-        GROUP BY td.TermName, td.TestName, td.Subject, td.Grade,
-        td.SchoolName, td.UserID, td.TeacherCode, td.TeacherFirstName,
-        td.TeacherLastName, td.ClassID, td.ClassName, tda.StandardNbr
-        """, cnxn, parse_dates=["MostRecentDate"])
+    # Batch runs may be making it from another process at the same time.
+    os.makedirs(extracts, exist_ok=True)
+    if delta_only:
+        # Never replaces an earlier delta, whose rows are already
+        # marked exported.
+        n = sheet_writer.stamped_path(os.path.join(
+            extracts, dname + ' Form B Data 2017-18 Delta'))
+    else:
+        n = os.path.join(extracts, dname + ' Form B Data 2017-18.xlsx')
+    workbook = sheet_writer.open_workbook(n)
+    header = workbook.add_format({'bold': True})
+
+    district = [districtID]
+    synced = {
+        'box': (_benchmarks, district, {'parse_dates': ['ResultDate']}),
+        'box2': (_state_scores, [
+            districtID, '20%-20%{}%'.format(state_test), achievement_level],
+            {}),
+    }
+    jobs = {}
+    banks = state_test in _standards_queries and not delta_only
+    if not delta_only:
+        synced['facts'] = (_answer_facts, district, {})
+        jobs['questions'] = (_question_map, district, {})
+    if banks:
+        points_query, programs_query = _standards_queries[state_test]
+        jobs['points'] = (points_query, district, {})
+        if 'Program' in _standards_cuts[state_test]:
+            jobs['programs'] = (programs_query, district, {})
+
+    # The syncs share one fetch of the district's result IDs.
+    ids = result_store.result_ids(districtID)
+    # None of these depend on each other, so run them all at once.
+    frames = query_runner.run_queries(jobs, connect, max_workers, {
+        name: (result_store.sync, (query, districtID, params, connect),
+               dict(kwargs, ids=ids))
+        for name, (query, params, kwargs) in synced.items()})
+    order = {'box': 'UpdatedDate desc'}
+    # name -> (since, until) of the rows not yet in a delta file
+    pending = {
+        name: result_store.pending_export(query, districtID, params)
+        if delta_only else (None, None)
+        for name, (query, params, kwargs) in synced.items()}
+
+    def results(name):
+        """Return a synced job's rows as an iterable of DataFrames."""
+        query, params, kwargs = synced[name]
+        since, until = pending[name]
+        rows = result_store.read(query, districtID, chunksize,
+                                 order.get(name), since=since, until=until,
+                                 **kwargs)
+        if chunksize is not None:
+            return rows
+        # A query that has never returned a row reads back no columns.
+        return [rows] if len(rows.columns) else []
+
+    students = set()
+    sheet_writer.stream_sheet(
+        workbook, 'Linkit Benchmarks',
+        (benchmark_rows(box) for box in demographics.collect_students(
+            results('box'), students)),
+        # A delta always has the same sheets, even with nothing new.
+        header, skip_empty=not delta_only, columns=_benchmark_columns)
+    sheet_writer.stream_sheet(
+        workbook, state_test,
+        (state_score_rows(box2) for box2 in demographics.collect_students(
+            results('box2'), students)),
+        header, columns=_state_score_columns)
+    if delta_only:
+        # The summed and demographic sheets only make sense whole.
+        workbook.close()
+        for name, (query, params, kwargs) in synced.items():
+            result_store.mark_exported(query, districtID, params,
+                                       pending[name][1])
+        return ("{} Benchmark Delta Extract created and saved "
+                "successfully.\nLocation: {}").format(dname, n)
+
+    # Standards and Skills, summed a chunk of answers at a time
+    questions = frames.pop('questions')
+    standards, skills = [], []
+    for facts in results('facts'):
+        standards.append(
+            points_by_question(facts, questions, 'Standard', 'StandardNbr'))
+        skills.append(points_by_question(facts, questions, 'Skill', 'Skills'))
+    del questions
+
+    box3 = merge_points(standards, 'StandardNbr')
     if(not box3.empty):
-        box3['Form'] = box3.apply(lambda row: row.TestName[
-            row.TestName.find("Form") + 5], axis=1)
-        box3['TermName'] = box3.apply(
-            lambda row: clean_term2(row), axis=1)
-        box3 = box3[[
-            'TermName', 'TestName', 'Subject', 'Grade', 'Form', 'SchoolName',
-            'UserID', 'TeacherCode', 'TeacherFirstName', 'TeacherLastName',
-            'ClassID', 'ClassName', 'StandardNbr',
-            'TotalPointsEarned', 'TotalPointsPossible']]
-        box3.to_excel(writer, sheet_name='Standards', index=False)
-
-    # Skills
-
-    box4 = pd.read_sql(
-        """declare @districtid int, @resultdate datetime
-        set @districtid="""+districtID+"""
-        set @resultdate='2017-08-01'
-        SET NOCOUNT ON
-
-        --- Skills---
-        DECLARE @testdata3 TABLE (ID int IDENTITY(1,1), VirtualTestID
-        INT, TestName VARCHAR(1000), Subject VARCHAR(1000), Grade
-        VARCHAR(25), SchoolID INT, SchoolName VARCHAR(1000),
-        TestResultID INT, UserID INT, TeacherCode VARCHAR(1000),
-        TeacherFirstName VARCHAR (100), TeacherLastName VARCHAR(1000),
-        ClassID INT, ClassName VARCHAR(1000), TermName VARCHAR(1000),
-        updateddate datetime)
-
-        DECLARE @testdata3a TABLE (ID int IDENTITY(1,1), StandardNbr
-        VARCHAR(1200), TotalPointsEarned INT, TotalPointsPossible INT,
-        ClassID INT, UserID INT, VirtualTestID INT, TestResultID INT)
-
-        INSERT INTO @testdata3 (VirtualTestID, SchoolID, UserID,
-        ClassID, TestResultID, updateddate)
-        SELECT tr.VirtualTestID, tr.SchoolID, tr.UserID, tr.ClassID,
-        tr.TestResultID, tr.updateddate
-        FROM TestResult AS tr INNER JOIN
-        [User] AS u ON tr.UserID = u.UserID
-        WHERE    (u.DistrictID = @districtid) AND (tr.ResultDate >
-        @resultdate)
-
-
-        UPDATE @testdata3
-        SET SchoolName = sc.Name
-        FROM @testdata3 AS td INNER JOIN
-        School AS sc ON td.SchoolID = sc.SchoolID
-
-        UPDATE @testdata3
-        SET Subject = sb.Name, Grade = g.Name, TestName = vt.Name
-        FROM @testdata3 AS td INNER JOIN
-        VirtualTest AS vt ON td.VirtualTestID = vt.VirtualTestID INNER
-        JOIN Bank AS b ON vt.BankID = b.BankID INNER JOIN
-        Subject AS sb ON b.SubjectID = sb.SubjectID INNER JOIN
-        Grade AS g ON sb.GradeID = g.GradeID
-
-        UPDATE @testdata3
-        SET ClassName = c.Name, TermName = dt.Name
-        FROM @testdata3 AS td INNER JOIN
-        Class AS c ON td.ClassID = c.ClassID INNER JOIN
-        DistrictTerm AS dt ON c.DistrictTermID = dt.DistrictTermID
-
-        UPDATE @testdata3
-        SET TeacherCode = u.Code, TeacherFirstName = u.NameFirst,
-        TeacherLastName = u.NameLast
-        FROM @testdata3 AS td INNER JOIN
-        [User] AS u ON td.UserID = u.UserID
-
-
-        INSERT INTO @testdata3a (StandardNbr, ClassID, UserID,
-        VirtualTestID, TotalPointsEarned, TotalPointsPossible,
-        TestResultID)
-        SELECT ms.Name, td.ClassID, td.UserID, td.VirtualTestID,
-        a.PointsEarned, a.PointsPossible, td.TestResultID
-        FROM @testdata3 AS td INNER JOIN
-        Answer AS a ON td.TestResultID = a.TestResultID INNER JOIN
-        VirtualQuestion AS vq ON a.VirtualQuestionID =
-        vq.VirtualQuestionID INNER JOIN
-        QTIItem AS q ON vq.QTIItemID = q.QTIItemID INNER JOIN
-        VirtualQuestionLessonOne AS vqss ON vq.VirtualQuestionID =
-        vqss.VirtualQuestionID INNER JOIN
-        LessonOne AS ms ON vqss.LessonOneID = ms.LessonOneID
-
-        SELECT min(td.updateddate) as EarliestDate ,max(td.updateddate)
-        as MostRecentDate,  td.TermName, td.TestName, td.Subject,
-        td.Grade, td.SchoolName, td.UserID, td.TeacherCode,
-        td.TeacherFirstName, td.TeacherLastName, td.ClassID,
-        td.ClassName,  replace(replace(tda.StandardNbr, char(10), ''),
-        char(13), '') as Skills , SUM(tda.TotalPointsEarned) As
-        TotalPointsEarned, SUM(tda.TotalPointsPossible) AS
-        TotalPointsPossible FROM @testdata3 AS td INNER JOIN
-        @testdata3a AS tda ON td.TestResultID = tda.TestResultID
-        where td.TestName like '%linkit%form%' and not (td.TestName like
-        '%Link%it%form%CR%' or td.TestName like '%Retake%')
-        GROUP BY td.TermName, td.TestName, td.Subject, td.Grade,
-        td.SchoolName, td.UserID, td.TeacherCode, td.TeacherFirstName,
-        td.TeacherLastName, td.ClassID, td.ClassName,
-        tda.StandardNbr""", cnxn, parse_dates=["MostRecentDate"])
+        box3 = question_rows(box3, 'StandardNbr')
+        sheet_writer.add_sheet(workbook, 'Standards', box3, header)
 
+    box4 = merge_points(skills, 'Skills')
     if(not box4.empty):
-        box4['Form'] = box4.apply(
-            lambda row: row.TestName[row.TestName.find("Form") + 5], axis=1)
-        box4['TermName'] = box4.apply(
-            lambda row: clean_term2(row), axis=1)
-        box4 = box4[[
-            'TermName', 'TestName', 'Subject', 'Grade', 'Form', 'SchoolName',
-            'UserID', 'TeacherCode', 'TeacherFirstName', 'TeacherLastName',
-            'ClassID', 'ClassName', 'Skills',
-            'TotalPointsEarned', 'TotalPointsPossible']]
-        box4.to_excel(writer, sheet_name='Skills', index=False)
-
-    # Gender
-    boxg = pd.read_sql(
-        """declare @district int
-        set @district="""+districtID+"""
-
-        select s.StudentID, g.name as Gender from student s With (nolock)
-        join gender g With (nolock) on g.GenderID=s.GenderID
-        where s.DistrictID=@district
-        """, cnxn)
-
-    boxg.to_excel(writer, sheet_name='Gender', index=False)
-
-    # Race
-    boxg = pd.read_sql(
-        """declare @district int
-        set @district="""+districtID+"""
-
-        select s.StudentID, r.name as Race from student s With (nolock)
-        join race r With (nolock) on r.raceid=s.raceid
-        where s.districtid=@district
-        """, cnxn)
-
-    boxg.to_excel(writer, sheet_name='Race', index=False)
-
-    # Program
-    boxg = pd.read_sql(
-        """declare @district int
-        set @district="""+districtID+"""
-
-        select sp.StudentID, p.name as Program from studentprogram sp
-        With (nolock)
-        join program p With (nolock) on p.programid=sp.programid
-        where p.districtid=@district
-        """, cnxn)
-
-    boxg.to_excel(writer, sheet_name='Program', index=False)
-
-    if state_test == 'PARCC':
-        # Standards by Gender
-        boxg = pd.read_sql(
-            """declare @district int
-            set @district="""+districtID+"""
-
-            select SCHOOL.NAME AS 'School',
-            Virtualtest.name as 'Test Name',
-            Gender.name as 'Gender',
-            MasterStandard.Number,
-            SUM(ANSWER.POINTSEARNED) AS 'Points Earned',
-            sum(answer.PointsPossible) as 'Points Possible'
-            FROM VIRTUALTEST WITH (NOLOCK)
-            INNER JOIN TestResult WITH (NOLOCK)
-            ON TESTRESULT.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN SCHOOL WITH (NOLOCK)
-            ON SCHOOL.SCHOOLID = TESTRESULT.SCHOOLID
-            INNER JOIN STUDENT WITH (NOLOCK)
-            ON STUDENT.STUDENTID = TESTRESULT.STUDENTID
-            INNER JOIN GENDER WITH (NOLOCK)
-            ON STUDENT.GenderID = GENDER.GenderID
-            INNER JOIN VirtualQuestion WITH (NOLOCK)
-            ON VIRTUALQUESTION.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN VIRTUALQUESTIONSTATESTANDARD WITH (NOLOCK)
-            ON VIRTUALQUESTIONSTATESTANDARD.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            INNER JOIN MASTERSTANDARD WITH (NOLOCK)
-            ON MASTERSTANDARD.MASTERSTANDARDID
-            = VIRTUALQUESTIONSTATESTANDARD.STATESTANDARDID
-            INNER JOIN ANSWER WITH (NOLOCK)
-            ON ANSWER.TESTRESULTID
-            = TESTRESULT.TESTRESULTID
-            AND ANSWER.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            WHERE VIRTUALTEST.BANKID IN (
-            59164,59163,59075,59089,59076,59091,59077,59090,59079,59092,
-            59081,59093,59084,59094,59085,59095,59086,59096,59074,59088,
-            59087,59098,60246,59123,59134,59124,59135,59125,59136,59126,
-            59137,59127,59138,59128,59139,59129,59140,59130,59141,59131,
-            59133,59132,59142,59171,59170)
-            AND STUDENT.DISTRICTID = @district
-            GROUP BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            GENDER.Name,
-            MasterStandard.Number
-            order by School.Name,
-            virtualtest.Name,
-            MasterStandard.Number,
-            Gender.Name
-            """, cnxn)
-
-        boxg.to_excel(writer, sheet_name='Standards by Gender', index=False)
-
-        # Standards by Race
-        boxg = pd.read_sql(
-            """declare @district int
-            set @district="""+districtID+"""
-
-            SELECT	SCHOOL.NAME AS 'School',
-            Virtualtest.name as 'Test Name',
-            Race.name as 'Race',
-            MasterStandard.Number,
-            SUM(ANSWER.POINTSEARNED) AS 'Points Earned',
-            sum(answer.PointsPossible) as 'Points Possible'
-            FROM VIRTUALTEST WITH (NOLOCK)
-            INNER JOIN TestResult WITH (NOLOCK)
-            ON TESTRESULT.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN SCHOOL WITH (NOLOCK)
-            ON SCHOOL.SCHOOLID = TESTRESULT.SCHOOLID
-            INNER JOIN STUDENT WITH (NOLOCK)
-            ON STUDENT.STUDENTID = TESTRESULT.STUDENTID
-            INNER JOIN Race WITH (NOLOCK)
-            ON STUDENT.RaceID = RACE.RaceID
-            INNER JOIN VirtualQuestion WITH (NOLOCK)
-            ON VIRTUALQUESTION.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN VIRTUALQUESTIONSTATESTANDARD WITH (NOLOCK)
-            ON VIRTUALQUESTIONSTATESTANDARD.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            INNER JOIN MASTERSTANDARD WITH (NOLOCK)
-            ON MASTERSTANDARD.MASTERSTANDARDID
-            = VIRTUALQUESTIONSTATESTANDARD.STATESTANDARDID
-            INNER JOIN ANSWER WITH (NOLOCK)
-            ON ANSWER.TESTRESULTID = TESTRESULT.TESTRESULTID
-            AND ANSWER.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            WHERE VIRTUALTEST.BANKID IN (
-            59164,59163,59075,59089,59076,59091,59077,59090,59079,59092,
-            59081,59093,59084,59094,59085,59095,59086,59096,59074,59088,
-            59087,59098,60246,59123,59134,59124,59135,59125,59136,59126,
-            59137,59127,59138,59128,59139,59129,59140,59130,59141,59131,
-            59133,59132,59142,59171,59170)
-            AND STUDENT.DISTRICTID = @district
-            GROUP BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            Race.Name,
-            MasterStandard.Number
-            ORDER BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            MASTERSTANDARD.Number,
-            RACE.Name
-            """, cnxn)
-
-        boxg.to_excel(writer, sheet_name='Standards by Race', index=False)
-
-        # Standards by Program
-        boxg = pd.read_sql(
-            """declare @district int
-            set @district="""+districtID+"""
-
-            SELECT	SCHOOL.NAME AS 'School',
-            Virtualtest.name as 'Test Name',
-            PROGRAM.name as 'Program',
-            MasterStandard.Number,
-            SUM(ANSWER.POINTSEARNED) AS 'Points Earned',
-            sum(answer.PointsPossible) as 'Points Possible'
-            FROM VIRTUALTEST WITH (NOLOCK)
-            INNER JOIN TestResult WITH (NOLOCK)
-            ON TESTRESULT.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN SCHOOL WITH (NOLOCK)
-            ON SCHOOL.SCHOOLID = TESTRESULT.SCHOOLID
-            INNER JOIN STUDENT WITH (NOLOCK)
-            ON STUDENT.STUDENTID = TESTRESULT.STUDENTID
-            INNER JOIN TestResultProgram WITH (NOLOCK)
-            ON TestResultProgram.TestResultID = testresult.TestResultID
-            INNER JOIN Program WITH (NOLOCK)
-            ON TestResultProgram.PROGRAMID = PROGRAM.PROGRAMID
-            INNER JOIN VirtualQuestion WITH (NOLOCK)
-            ON VIRTUALQUESTION.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN VIRTUALQUESTIONSTATESTANDARD WITH (NOLOCK)
-            ON VIRTUALQUESTIONSTATESTANDARD.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            INNER JOIN MASTERSTANDARD WITH (NOLOCK)
-            ON MASTERSTANDARD.MASTERSTANDARDID
-            = VIRTUALQUESTIONSTATESTANDARD.STATESTANDARDID
-            INNER JOIN ANSWER WITH (NOLOCK)
-            ON ANSWER.TESTRESULTID = TESTRESULT.TESTRESULTID
-            AND ANSWER.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            WHERE VIRTUALTEST.BANKID IN (
-            59164,59163,59075,59089,59076,59091,59077,59090,59079,59092,
-            59081,59093,59084,59094,59085,59095,59086,59096,59074,59088,
-            59087,59098,60246,59123,59134,59124,59135,59125,59136,59126,
-            59137,59127,59138,59128,59139,59129,59140,59130,59141,59131,
-            59133,59132,59142,59171,59170)
-            AND STUDENT.DISTRICTID = @district
-            GROUP BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            Program.Name,
-            MasterStandard.Number
-            ORDER BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            MASTERSTANDARD.Number,
-            PROGRAM.Name
-            """, cnxn)
-
-        boxg.to_excel(writer, sheet_name='Standards by Program', index=False)
-    elif state_test == "PSSA":
-        # Standards by Gender
-        boxg = pd.read_sql(
-            """declare @district int
-            set @district="""+districtID+"""
-
-            SELECT	SCHOOL.NAME AS 'School',
-            Virtualtest.name as 'Test Name',
-            Gender.name as 'Gender',
-            MasterStandard.Number,
-            SUM(ANSWER.POINTSEARNED) AS 'Points Earned',
-            sum(answer.PointsPossible) as 'Points Possible'
-            FROM VIRTUALTEST WITH (NOLOCK)
-            INNER JOIN TestResult WITH (NOLOCK)
-            ON TESTRESULT.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN SCHOOL WITH (NOLOCK)
-            ON SCHOOL.SCHOOLID = TESTRESULT.SCHOOLID
-            INNER JOIN STUDENT WITH (NOLOCK)
-            ON STUDENT.STUDENTID = TESTRESULT.STUDENTID
-            INNER JOIN GENDER WITH (NOLOCK)
-            ON STUDENT.GenderID = GENDER.GenderID
-            INNER JOIN VirtualQuestion WITH (NOLOCK)
-            ON VIRTUALQUESTION.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN VIRTUALQUESTIONSTATESTANDARD WITH (NOLOCK)
-            ON VIRTUALQUESTIONSTATESTANDARD.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            INNER JOIN MASTERSTANDARD WITH (NOLOCK)
-            ON MASTERSTANDARD.MASTERSTANDARDID
-            = VIRTUALQUESTIONSTATESTANDARD.STATESTANDARDID
-            INNER JOIN ANSWER WITH (NOLOCK)
-            ON ANSWER.TESTRESULTID = TESTRESULT.TESTRESULTID
-            AND ANSWER.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            WHERE VIRTUALTEST.BANKID IN (
-            58520,58522,58523,58524,58525,58526,58527,58528,58529,58530,
-            58531,58532,58667,58668,58669,58670,58671,58672,58922,58923)
-            AND STUDENT.DISTRICTID = @district
-            GROUP BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            GENDER.Name,
-            MasterStandard.Number
-            order by School.Name,
-            virtualtest.Name,
-            MasterStandard.Number,
-            Gender.Name
-            """, cnxn)
-
-        boxg.to_excel(writer, sheet_name='Standards by Gender', index=False)
-
-        # Standards by Race
-        boxg = pd.read_sql(
-            """declare @district int
-            set @district="""+districtID+"""
-
-            SELECT	SCHOOL.NAME AS 'School',
-            Virtualtest.name as 'Test Name',
-            Race.name as 'Race',
-            MasterStandard.Number,
-            SUM(ANSWER.POINTSEARNED) AS 'Points Earned',
-            sum(answer.PointsPossible) as 'Points Possible'
-            FROM VIRTUALTEST WITH (NOLOCK)
-            INNER JOIN TestResult WITH (NOLOCK)
-            ON TESTRESULT.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN SCHOOL WITH (NOLOCK)
-            ON SCHOOL.SCHOOLID = TESTRESULT.SCHOOLID
-            INNER JOIN STUDENT WITH (NOLOCK)
-            ON STUDENT.STUDENTID = TESTRESULT.STUDENTID
-            INNER JOIN Race WITH (NOLOCK)
-            ON STUDENT.RaceID = RACE.RaceID
-            INNER JOIN VirtualQuestion WITH (NOLOCK)
-            ON VIRTUALQUESTION.VIRTUALTESTID
-            = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN VIRTUALQUESTIONSTATESTANDARD WITH (NOLOCK)
-            ON VIRTUALQUESTIONSTATESTANDARD.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            INNER JOIN MASTERSTANDARD WITH (NOLOCK)
-            ON MASTERSTANDARD.MASTERSTANDARDID
-            = VIRTUALQUESTIONSTATESTANDARD.STATESTANDARDID
-            INNER JOIN ANSWER WITH (NOLOCK)
-            ON ANSWER.TESTRESULTID = TESTRESULT.TESTRESULTID
-            AND ANSWER.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            WHERE VIRTUALTEST.BANKID IN (
-            58520,58522,58523,58524,58525,58526,58527,58528,58529,58530,
-            58531,58532,58667,58668,58669,58670,58671,58672,58922,58923)
-            AND STUDENT.DISTRICTID = @district
-            GROUP BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            Race.Name,
-            MasterStandard.Number
-            ORDER BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            MASTERSTANDARD.Number,
-            RACE.Name
-            """, cnxn)
-
-        boxg.to_excel(writer, sheet_name='Standards by Race', index=False)
-
-        # Standards by Program
-        boxg = pd.read_sql(
-            """declare @district int
-            set @district="""+districtID+"""
-
-
-
-            SELECT	SCHOOL.NAME AS 'School',
-            Virtualtest.name as 'Test Name',
-            PROGRAM.name as 'Program',
-            MasterStandard.Number,
-            SUM(ANSWER.POINTSEARNED) AS 'Points Earned',
-            sum(answer.PointsPossible) as 'Points Possible'
-            FROM VIRTUALTEST WITH (NOLOCK)
-            INNER JOIN TestResult WITH (NOLOCK)
-            ON TESTRESULT.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN SCHOOL WITH (NOLOCK)
-            ON SCHOOL.SCHOOLID = TESTRESULT.SCHOOLID
-            INNER JOIN STUDENT WITH (NOLOCK)
-            ON STUDENT.STUDENTID = TESTRESULT.STUDENTID
-            INNER JOIN TestResultProgram WITH (NOLOCK)
-            ON TestResultProgram.TestResultID = testresult.TestResultID
-            INNER JOIN Program WITH (NOLOCK)
-            ON TestResultProgram.PROGRAMID = PROGRAM.PROGRAMID
-            INNER JOIN VirtualQuestion WITH (NOLOCK)
-            ON VIRTUALQUESTION.VIRTUALTESTID = VIRTUALTEST.VIRTUALTESTID
-            INNER JOIN VIRTUALQUESTIONSTATESTANDARD WITH (NOLOCK)
-            ON VIRTUALQUESTIONSTATESTANDARD.VIRTUALQUESTIONID
-            = VIRTUALQUESTION.VIRTUALQUESTIONID
-            INNER JOIN MASTERSTANDARD WITH (NOLOCK)
-            ON MASTERSTANDARD.MASTERSTANDARDID
-            = VIRTUALQUESTIONSTATESTANDARD.STATESTANDARDID
-            INNER JOIN ANSWER WITH (NOLOCK)
-            ON ANSWER.TESTRESULTID = TESTRESULT.TESTRESULTID
-            AND ANSWER.VIRTUALQUESTIONID = VIRTUALQUESTION.VIRTUALQUESTIONID
-            WHERE VIRTUALTEST.BANKID IN (
-            58520,58522,58523,58524,58525,58526,58527,58528,58529,58530,
-            58531,58532,58667,58668,58669,58670,58671,58672,58922,58923)
-            AND STUDENT.DISTRICTID = @district
-            GROUP BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            Program.Name,
-            MasterStandard.Number
-            ORDER BY SCHOOL.Name,
-            VIRTUALTEST.Name,
-            MASTERSTANDARD.Number,
-            PROGRAM.Name
-            """, cnxn)
-
-    # Do all .to_excel calls (USE WRITER) before calling this
-    writer.save()
+        box4['Skills'] = box4.Skills.str.replace(r"[\r\n]", "", regex=True)
+        box4 = question_rows(box4, 'Skills')
+        sheet_writer.add_sheet(workbook, 'Skills', box4, header)
+    del standards, skills, box3, box4
+
+    # Gender, Race and Program
+    demo = demographics.district_demographics(districtID, connect)
+    sheets = demographics.demographic_sheets(
+        demo, students if scored_only else None)
+    for column, boxg in sheets.items():
+        sheet_writer.add_sheet(workbook, column, boxg, header)
+    del demo, sheets
+
+    # Standards by Gender, Race and Program
+    if banks:
+        points = frames.pop('points')
+        for column in _standards_cuts[state_test]:
+            rows = points
+            if column == 'Program':
+                rows = points.merge(frames.pop('programs'),
+                                    on='TestResultID')
+            boxg = standards_by(rows, column)
+            sheet_writer.add_sheet(
+                workbook, 'Standards by ' + column, boxg, header)
+        del points, rows
+
+    # Write every sheet before calling this
+    workbook.close()
     return_string = ("{} Benchmark Extract created and saved successfully.\n"
                      "Location: {}").format(dname, n)
     return (return_string)
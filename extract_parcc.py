@@ -1,161 +1,238 @@
 """Create PARCC report data extract."""
-import pandas as pd
 import os
 import os.path
-import mal_data as mal
+import connection_pool
+import demographics
+import districts
+import queries
+import query_runner
+import result_store
+import sheet_writer
 
+# Compact dtypes for both queries' columns, applied as soon as rows are
+# fetched; see queries.compact. Subject stays text, as score_rows
+# renames one of its values.
+_schema = dict(
+    [(column, 'category') for column in [
+        'TestName', 'Grade', 'SchoolID', 'StudentCode',
+        'StudentFirstName', 'StudentLastName', 'ProfLevel', 'ClassName',
+        'ClusterName', 'Prof']]
+    + [(column, 'integer') for column in [
+        'TestResultID', 'TestResultScoreID', 'StudentID', 'ClassID',
+        'ScaledScore', 'Score']])
 
-def extract(districtID):
-    """Create the extract and save it as a .xlsx file."""
-    # Get a connection to the database.
-    database = mal.setup_SQL()
-    # Query the database for the district name.
-    district_name = mal.get_district_name(districtID, database)
+# PARCC score facts, one row per test result score. Both the Score and
+# the Cluster sheet are built from these, so the server only walks the
+# score rows once. N/A tests are left in for the Cluster sheet;
+# score_rows drops them. ClassID and ClassName are blank for results
+# without a class. Both queries here are synced into the local result
+# store.
+_scores = queries.register("parcc.scores", """
+declare @since datetime = ?
+declare @districtid int
+set @districtid=?
+select tr.TestResultID, tr.UpdatedDate, trs.TestResultScoreID,
+vt.Name as TestName, sub.name as Subject, gr.Name as
+Grade, sch.Name as SchoolID, s.StudentID, s.code as StudentCode,
+s.FirstName as StudentFirstName, s.LastName as StudentLastName,
+trs.ScoreScaled as ScaledScore, trs.AchievementLevel as
+ProfLevel, c.ClassID, c.Name as ClassName
+from TestResultScore trs With (nolock)
+join testresult tr With (nolock) on
+tr.testresultid=trs.testresultid
+join virtualtest vt With (nolock) on
+vt.VirtualTestID=tr.VirtualTestID
+join bank b With (nolock) on b.BankID =vt.bankid
+join subject sub With (nolock) on sub.subjectid=b.SubjectID
+join grade gr With (nolock) on gr.GradeID=sub.GradeID
+join student s With (nolock) on s.studentid=tr.StudentID
+join school sch With (nolock) on sch.SchoolID=tr.SchoolID
+left join class c With (nolock) on c.ClassID=tr.ClassID
+where sch.DistrictID=@districtid
+and vt.Name like '20%-20%PARCC%'
+and vt.achievementlevelsettingid=217 and tr.UpdatedDate > @since""", _schema)
+
+# PARCC cluster subscores, one row per subscore, keyed by the score
+# they belong to. Only the keys needed to find the district's PARCC
+# results are joined; everything else comes from _scores.
+_subscores = queries.register("parcc.subscores", """
+declare @since datetime = ?
+declare @districtid int
+set @districtid=?
+select tr.TestResultID, tr.UpdatedDate, tss.TestResultScoreID,
+tss.Name as ClusterName, tss.ScoreScaled as Score,
+tss.AchievementLevel as Prof
+from TestResultSubScore tss With (nolock)
+join TestResultScore trs With (nolock) on
+trs.TestResultScoreID=tss.TestResultScoreID
+join testresult tr With (nolock) on
+tr.testresultid=trs.testresultid
+join virtualtest vt With (nolock) on
+vt.VirtualTestID=tr.VirtualTestID
+join school sch With (nolock) on sch.SchoolID=tr.SchoolID
+where sch.DistrictID=@districtid
+and vt.Name like '20%-20%PARCC%'
+and vt.achievementlevelsettingid=217 and tr.UpdatedDate > @since""", _schema)
+
+# Grade given to end-of-course tests, by text in the test name. Later
+# entries win, so Alg II isn't taken for Alg I.
+_course_grades = [('Alg I', 9), ('Geo', 10), ('Alg II', 11)]
+
+
+def nav_grades(names, grades):
+    """Return the Navigator grade: a course's grade, else the test's."""
+    nav = grades.astype(object)
+    for course, grade in _course_grades:
+        nav = nav.mask(names.str.contains(course, regex=False, na=False),
+                       grade)
+    return nav
+
+
+def cluster_totals(cluster):
+    """Add each test, school and cluster's NUM and DIV to every row.
+
+    NUM sums the scores of a Scale Score cluster, and counts the scores
+    of 1 for any other. DIV counts the scores. Rows missing a test,
+    school or cluster name get neither.
+    """
+    keys = [cluster.TestName, cluster.School, cluster.ClusterName]
+    scale = cluster.ClusterName.str.contains(
+        "Scale Score", regex=False, na=False)
+    counted = cluster.Score.where(scale, (cluster.Score == 1).astype(int))
+    cluster['NUM'] = counted.groupby(keys, observed=True).transform('sum')
+    cluster['DIV'] = cluster.Score.groupby(
+        keys, observed=True).transform('count')
+    return cluster
+
+
+def cluster_rows(scores, subscores):
+    """Join subscores to their scores' test, school and class.
+
+    Subscores of results without a class are left out.
+    """
+    scores = scores.dropna(subset=['ClassID']).rename(columns={
+        'SchoolID': 'School', 'ClassName': 'Class Name'})
+    return subscores.merge(scores, on='TestResultScoreID')
+
+
+# Columns of the Score sheet.
+_score_columns = [
+    'Year', 'TestName', 'Subject', 'Grade', 'NAVGrade',
+    'SchoolID', 'StudentID', 'StudentCode', 'StudentFirstName',
+    'StudentLastName', 'ScaledScore', 'ProfLevel']
+
+
+def score_rows(score):
+    """Shape PARCC scores for the Score sheet, leaving out N/A tests."""
+    score = score[~score.TestName.str.contains(
+        'N/A', case=False, regex=False, na=False)].copy()
+    score['Year'] = score.TestName.str[5:9]
+    score['NAVGrade'] = nav_grades(score.TestName, score.Grade)
+    score.loc[score.Subject == 'Language Arts', 'Subject'] = 'ELA'
+    return score[_score_columns]
+
+
+def extract(districtID, max_workers=None, chunksize=None,
+            scored_only=False, delta_only=False):
+    """Create the extract and save it as a .xlsx file.
+
+    The scores are first synced into the local result store, fetching
+    only what changed since the last run, then read from there.
+
+    max_workers -- most queries to run against the database at once
+    chunksize -- stream the row-level results this many rows at a time,
+        keeping memory use flat (default: result_store.chunk_rows());
+        0 reads them whole
+    scored_only -- only list demographics for students with scores
+    delta_only -- write only the Score rows that are new or changed
+        since the last delta export, to a separate Delta file
+    """
+    connect = connection_pool.setup_SQL
+    chunksize = result_store.chunk_rows(chunksize)
+    # Look up the district name, remembered from earlier runs if we can.
+    district_name = districts.lookup(districtID, connect).Name
     # Make sure /Extracts directory exists and sets the output path.
     extracts = os.path.join(os.getcwd(), "Extracts")
-    if not os.path.exists(extracts):
-        os.makedirs(extracts)
-    file_name = os.path.join(
-        extracts, '{} 3-Year PARCC Data.xlsx'.format(district_name))
+    # Batch runs may be making it from another process at the same time.
+    os.makedirs(extracts, exist_ok=True)
+    if delta_only:
+        # Never replaces an earlier delta, whose rows are already
+        # marked exported.
+        file_name = sheet_writer.stamped_path(os.path.join(
+            extracts, district_name + ' 3-Year PARCC Data Delta'))
+    else:
+        file_name = os.path.join(
+            extracts, '{} 3-Year PARCC Data.xlsx'.format(district_name))
     # Get our output file set up for writing.
-    file = mal.setup_writer(name=file_name)
-
-    # Query the database and store it in a pandas DataFrame.
-    score = pd.read_sql(
-        """declare @districtid int
-        set @districtid={}
-        select vt.Name as TestName, sub.name as Subject, gr.Name as
-        Grade, sch.Name as SchoolID, s.StudentID, s.code as StudentCode,
-        s.FirstName as StudentFirstName, s.LastName as StudentLastName,
-        trs.ScoreScaled as ScaledScore, trs.AchievementLevel as
-        ProfLevel from TestResultScore trs With (nolock)
-        join testresult tr With (nolock) on
-        tr.testresultid=trs.testresultid
-        join virtualtest vt With (nolock) on
-        vt.VirtualTestID=tr.VirtualTestID
-        join bank b With (nolock) on b.BankID =vt.bankid
-        join subject sub With (nolock) on sub.subjectid=b.SubjectID
-        join grade gr With (nolock) on gr.GradeID=sub.GradeID
-        join student s With (nolock) on s.studentid=tr.StudentID
-        join school sch With (nolock) on sch.SchoolID=tr.SchoolID
-        where sch.DistrictID=@districtid
-        and (vt.Name like '20%-20%PARCC%' and vt.Name not like '%N/A%')
-        and vt.achievementlevelsettingid=217""".format(districtID),
-        database)
-
-    score['Year'] = score.apply(lambda row: row.TestName[5:9], axis=1)
-    score['NAVGrade'] = score.apply(lambda row:
-                                    11 if 'Alg II' in row.TestName else
-                                    10 if 'Geo' in row.TestName else
-                                    9 if 'Alg I' in row.TestName else
-                                    row.Grade, axis=1)
-    score.loc[score.Subject == 'Language Arts', 'Subject'] = 'ELA'
-    score = score[[
-        'Year', 'TestName', 'Subject', 'Grade', 'NAVGrade',
-        'SchoolID', 'StudentID', 'StudentCode', 'StudentFirstName',
-        'StudentLastName', 'ScaledScore', 'ProfLevel']]
-    score.to_excel(file, sheet_name='Score', index=False)
-
-    del score
-
-    cluster = pd.read_sql(
-        """Declare @districtid int
-        set @districtid = """
-        + districtID +
-        """
-
-
-        Select
-        District.Name as [District],
-        TestResult.ResultDate as [Date],
-        VirtualTest.Name as [TestName],
-        School.Name as [School],
-        Class.ClassID AS [ClassID],
-        Class.Name AS [Class Name],
-        TestResultSubScore.Name AS [ClusterName],
-        TestResultSubScore.ScoreScaled AS [Score],
-        TestResultSubScore.AchievementLevel AS [Prof]
-
-        from TestResult with (nolock)
-            inner join TestResultScore as trs with (nolock) on
-            trs.TestResultID=TestResult.TestResultID
-            inner join VirtualTest with (nolock) on
-            TestResult.VirtualTestID=VirtualTest.VirtualTestID
-            inner join DistrictTerm with (nolock) on
-            TestResult.DistrictTermID=DistrictTerm.DistrictTermID
-            inner join District with (nolock) on
-            District.DistrictID=DistrictTerm.DistrictID
-            inner join Student with (nolock) on
-            TestResult.StudentID=Student.StudentID
-            inner join School with (nolock) on
-            TestResult.SchoolID=School.SchoolID
-            inner join Class with (nolock) on
-            TestResult.ClassID=Class.ClassID
-            inner join [User] with (nolock) on
-            TestResult.UserID=[User].UserID
-            inner join TestResultSubScore with (nolock) on
-            TestResultSubScore.TestResultScoreID=trs.TestResultScoreID
-
-        where District.DistrictID=@districtid
-        AND VirtualTest.Name LIKE '20%-20%PARCC%'
-        AND VirtualTest.achievementlevelsettingid=217""", database)
-
-    cluster['one'] = cluster["Score"] == 1
-    grouped = cluster.groupby(by=["TestName", "School", "ClusterName"])
-    for key in grouped.groups.keys():
-        (t, s, c) = key[0][:], key[1][:], key[2][:]
-        num_col = "Score" if "Scale Score" in c else "one"
-        group = grouped.get_group(key)
-        num = group[num_col].sum()
-        div = group["Score"].count()
-
-        cluster.loc[(cluster.TestName == t) &
-                    (cluster.School == s) &
-                    (cluster.ClusterName == c),
-                    "NUM"] = num
-        cluster.loc[(cluster.TestName == t) &
-                    (cluster.School == s) &
-                    (cluster.ClusterName == c),
-                    "DIV"] = div
+    workbook = sheet_writer.open_workbook(file_name)
+    header = workbook.add_format({'bold': True})
+
+    district = [int(districtID)]
+    synced = {'Score': (_scores, district, {})}
+    if not delta_only:
+        synced['SubScore'] = (_subscores, district, {})
+    # Bring the local store up to date, every query at once, sharing one
+    # fetch of the district's result IDs.
+    ids = result_store.result_ids(districtID)
+    query_runner.run_queries({}, connect, max_workers, {
+        name: (result_store.sync, (query, int(districtID), params, connect),
+               dict(kwargs, ids=ids))
+        for name, (query, params, kwargs) in synced.items()})
+    # name -> (since, until) of the rows not yet in a delta file
+    pending = {
+        name: result_store.pending_export(query, districtID, params)
+        if delta_only else (None, None)
+        for name, (query, params, kwargs) in synced.items()}
+
+    def results(name):
+        """Return a synced job's rows as an iterable of DataFrames."""
+        query, params, kwargs = synced[name]
+        since, until = pending[name]
+        rows = result_store.read(query, districtID, chunksize,
+                                 since=since, until=until, **kwargs)
+        if chunksize is not None:
+            return rows
+        # A query that has never returned a row reads back no columns.
+        return [rows] if len(rows.columns) else []
+
+    students = set()
+    sheet_writer.stream_sheet(
+        workbook, 'Score',
+        (score_rows(score) for score in demographics.collect_students(
+            results('Score'), students)),
+        header, columns=_score_columns)
+    if delta_only:
+        # Cluster totals and demographics only make sense whole.
+        workbook.close()
+        for name, (query, params, kwargs) in synced.items():
+            result_store.mark_exported(query, districtID, params,
+                                       pending[name][1])
+        return (district_name
+                + " PARCC Delta Extract created and saved sucessfully."
+                + "\nLocation: "
+                + file_name)
+
+    cluster = cluster_totals(cluster_rows(
+        result_store.read(_scores, districtID, columns=[
+            'TestResultScoreID', 'TestName', 'SchoolID', 'ClassID',
+            'ClassName']),
+        result_store.read(_subscores, districtID, columns=[
+            'TestResultScoreID', 'ClusterName', 'Score'])))
     cluster = cluster[[
         'TestName', 'School', 'ClassID', 'Class Name', 'ClusterName',
         'NUM', 'DIV']]
-    cluster.to_excel(file, sheet_name='Cluster', index=False)
+    sheet_writer.add_sheet(workbook, 'Cluster', cluster, header)
     del cluster
-    # Gender
-    boxg = pd.read_sql(
-        """declare @district int
-        set @district={}
-        select s.StudentID, g.name as Gender
-        from student s With (nolock)
-        join gender g With (nolock) on g.GenderID=s.GenderID
-        where s.DistrictID=@district
-        """.format(districtID), database)
-    boxg.to_excel(file, sheet_name='Gender', index=False)
-    # Race
-    boxg = pd.read_sql(
-        """declare @district int
-        set @district={}
-        select s.StudentID, r.name as Race from student s With (nolock)
-        join race r With (nolock) on r.raceid=s.raceid
-        where s.districtid=@district
-        """.format(districtID), database)
-    boxg.to_excel(file, sheet_name='Race', index=False)
-    # Program
-    boxg = pd.read_sql(
-        """declare @district int
-        set @district={}
-        select sp.StudentID, p.name as Program
-        from studentprogram sp With (nolock)
-        join program p With (nolock) on
-        p.programid=sp.programid
-        where p.districtid=@district
-        """.format(districtID), database)
-    boxg.to_excel(file, sheet_name='Program', index=False)
-    del boxg
-
-    # do all .to_excel calls before calling this
-    file.save()
+    # Gender, Race and Program
+    demo = demographics.district_demographics(districtID, connect)
+    sheets = demographics.demographic_sheets(
+        demo, students if scored_only else None)
+    for name, boxg in sheets.items():
+        sheet_writer.add_sheet(workbook, name, boxg, header)
+    del demo, sheets
+
+    # write every sheet before calling this
+    workbook.close()
     # We're done! Send the user a message letting them know this.
     return (district_name
             + " PARCC Extract created and saved sucessfully."
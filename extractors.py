@@ -2,12 +2,15 @@
 
 import os
 import sys
+import threading
 import wx
 import extract_benchmark
 import extract_parcc
 import usage_report
 import benchmark_status
 import extractor_update
+import connection_pool
+import query_cache
 
 if getattr(sys, 'frozen', False):
     # running in a bundle
@@ -44,6 +47,10 @@ class ExtractFrame(wx.Frame):
         """Build menu bar and bind methods to each item."""
         # Make a file menu with Hello and Exit items
         fileMenu = wx.Menu()
+        refreshItem = fileMenu.AppendCheckItem(
+            -1, "&Refresh Data",
+            "Ignore cached query results and fetch everything fresh.")
+        refreshItem.Check(query_cache.refreshing())
         fileMenu.AppendSeparator()
         # When using a stock ID we don't need to specify the menu item's
         # label
@@ -88,11 +95,16 @@ class ExtractFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.OnExit,  exitItem)
         self.Bind(wx.EVT_MENU, self.OnAbout, aboutItem)
         self.Bind(wx.EVT_MENU, self.OnUpdate, updateItem)
+        self.Bind(wx.EVT_MENU, self.OnRefresh, refreshItem)
 
     def OnExit(self, event):
         """Close the frame, terminating the application."""
         self.Close(True)
 
+    def OnRefresh(self, event):
+        """Turn fetching fresh data instead of cached results on or off."""
+        query_cache.set_refresh(event.IsChecked())
+
     def BenchmarkExtract(self, event):
         """Extract Benchmark for Navigator Report."""
         districtID = self.getDistrictID()
@@ -112,7 +124,7 @@ class ExtractFrame(wx.Frame):
         if districtID is None:
             return False
         form = self.getForm()
-        if form not in ["A", "B", "C"]:
+        if form not in ["A", "B", "C", "All"]:
             return False
         # Code goes here - we have a valid districtID by this point.
         self.SetStatusText("Status: Extracting...")
@@ -164,14 +176,14 @@ class ExtractFrame(wx.Frame):
                 return s
 
     def getForm(self):
-        """Get A, B or C from user."""
+        """Get A, B, C or All from user."""
         dialog = wx.SingleChoiceDialog(self, "Select a Form", "Form",
-                                       choices=["A", "B", "C"])
+                                       choices=["A", "B", "C", "All"])
         while True:
             if dialog.ShowModal() == wx.ID_CANCEL:
                 break
             choice = dialog.GetSelection()
-            return ["A", "B", "C"][choice]
+            return ["A", "B", "C", "All"][choice]
 
     def AddExtract(self, name, event, help="", key=None):
         """Add an item to the extract menu on the menu bar.
@@ -205,12 +217,26 @@ class ExtractFrame(wx.Frame):
             wx.MessageBox("No Update Available.", "", wx.OK)
 
 
+def warm_connections():
+    """Open pooled connections ahead of the first extract, if we can."""
+    try:
+        connection_pool.warm()
+    except Exception as ex:
+        print("Could not warm connections:", ex)
+
+
 def main():
     """Launch an ExtractFrame."""
     # If we have just updated, remove old version.
     if os.path.exists("OLD.deleteme"):
         os.remove("OLD.deleteme")
+    # Start with cached query results ignored.
+    if "--refresh" in sys.argv[1:]:
+        query_cache.set_refresh()
 
+    # Log in to the servers in the background while the window opens, so
+    # the first extract doesn't wait on it.
+    threading.Thread(target=warm_connections, daemon=True).start()
     app = wx.App()
     frm = ExtractFrame(None, title='Extractor Hub')
     frm.Show()
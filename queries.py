@@ -0,0 +1,150 @@
+"""Registry of named, parameterized SQL queries.
+
+Query text never changes between runs; districts and dates are bound as
+? parameters by the driver. That lets SQL Server reuse one cached plan
+per query instead of compiling a new ad-hoc plan for every district.
+"""
+import contextlib
+import hashlib
+import time
+from collections import namedtuple
+import pandas as pd
+import query_cache
+
+# name -- stable identifier, e.g. "benchmark.answer_facts"
+# sql -- query text with ? parameter markers
+# digest -- short hash of sql, changes whenever the text does
+# schema -- dict of column -> compact dtype, see compact()
+Query = namedtuple("Query", ["name", "sql", "digest", "schema"])
+
+_registry = {}
+# Semaphore every query waits on before it runs, shared by all the
+# processes of a batch run to cap the load on the server; None for no
+# cap.
+_slots = None
+
+
+def register(name, sql, schema=None):
+    """Add a query to the registry and return it."""
+    if name in _registry and _registry[name].sql != sql:
+        raise ValueError("Query {} is already registered.".format(name))
+    digest = hashlib.sha1(sql.encode("utf-8")).hexdigest()[:12]
+    _registry[name] = Query(name, sql, digest, dict(schema or {}))
+    return _registry[name]
+
+
+def get(name):
+    """Return the registered query called name."""
+    return _registry[name]
+
+
+def names():
+    """Return the names of every registered query."""
+    return sorted(_registry)
+
+
+def set_slots(slots):
+    """Make every query wait for one of slots before it runs.
+
+    slots -- a semaphore, e.g. a multiprocessing.BoundedSemaphore
+        handed to every worker process, or None to lift the cap
+    """
+    global _slots
+    _slots = slots
+
+
+def slot():
+    """Return a context manager holding one query slot while it runs."""
+    if _slots is None:
+        return contextlib.nullcontext()
+    return _slots
+
+
+def memory(df):
+    """Return the bytes df takes up, counting the strings it holds."""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def compact(query, df):
+    """Convert df's columns to the dtypes in query's schema, in place.
+
+    A schema maps columns to one of:
+    'category' -- for text repeated on many rows, e.g. School or Grade
+    'integer' -- for IDs and counts, stored in the smallest int type
+        that holds them (left alone if a value is missing or fractional)
+
+    Returns df with its memory use before and after, in bytes.
+    """
+    if not query.schema:
+        return df, None, None
+    before = memory(df)
+    for column, kind in query.schema.items():
+        if column not in df:
+            continue
+        if kind == 'category':
+            df[column] = df[column].astype('category')
+        else:
+            df[column] = pd.to_numeric(df[column], downcast=kind)
+    return df, before, memory(df)
+
+
+def savings(before, after):
+    """Describe what compact() saved, for the end of a log line."""
+    if before is None:
+        return ""
+    return ", {:.1f} MB compacted to {:.1f} MB ({:.1f}x)".format(
+        before / 2 ** 20, after / 2 ** 20, before / max(after, 1))
+
+
+def read(query, cnxn, params=(), cache=True, **kwargs):
+    """Run a registered query with bound params into a DataFrame.
+
+    query -- a Query, or the name of one
+    params -- values for the query's ? markers, in order
+    cache -- use a recent result from query_cache if there is one, and
+        cache this one; pass False for queries that must be live
+    kwargs -- passed on to pd.read_sql
+    """
+    if isinstance(query, str):
+        query = get(query)
+    start = time.perf_counter()
+    if cache:
+        key = query_cache.key(query.name, query.digest, params, kwargs)
+        df = query_cache.load(key)
+        if df is not None:
+            print("{} [{}]: {} rows from cache in {:.2f}s".format(
+                query.name, query.digest, len(df),
+                time.perf_counter() - start))
+            return df
+    with slot():
+        df = pd.read_sql(query.sql, cnxn, params=list(params), **kwargs)
+    # Before anything else touches it, so every transform and the cache
+    # see the compact frame.
+    df, before, after = compact(query, df)
+    print("{} [{}]: {} rows in {:.2f}s{}".format(
+        query.name, query.digest, len(df), time.perf_counter() - start,
+        savings(before, after)))
+    if cache:
+        query_cache.save(key, df)
+    return df
+
+
+def read_chunks(query, cnxn, params=(), chunksize=50000, **kwargs):
+    """Run a registered query and yield its rows chunksize at a time.
+
+    Takes the same arguments as read(). Only one chunk is held in
+    memory at once.
+    """
+    if isinstance(query, str):
+        query = get(query)
+    start = time.perf_counter()
+    rows = 0
+    # The slot is held until the last chunk is read, as the query is
+    # running on the server all that time.
+    with slot():
+        for df in pd.read_sql(query.sql, cnxn, params=list(params),
+                              chunksize=chunksize, **kwargs):
+            rows = rows + len(df)
+            yield df
+    print("{} [{}]: {} rows streamed in {:.2f}s".format(
+        query.name, query.digest, rows, time.perf_counter() - start))
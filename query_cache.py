@@ -0,0 +1,116 @@
+"""On-disk cache of query results, keyed by query and bound parameters.
+
+Re-running an extract soon after the last one, e.g. to fix a formatting
+issue, reads its DataFrames back from here instead of repeating the
+database work. An entry's name is a hash of the query's name, the hash
+of its text and its parameters, so editing a query or asking for other
+parameters never hits a stale entry.
+
+Entries are gzipped pickles that expire _ttl after they were fetched.
+When the cache grows past its disk budget, the least recently used
+entries are deleted first.
+"""
+import datetime as dt
+import hashlib
+import os
+import os.path
+import threading
+import time
+import pandas as pd
+
+_cache_dir = os.path.join(os.getcwd(), "Cache", "Queries")
+# How old an entry may be before it is fetched again.
+_ttl = dt.timedelta(hours=float(os.environ.get("EXTRACTOR_CACHE_HOURS", 12)))
+# Most disk space the cache may use, in bytes.
+_budget = int(float(os.environ.get("EXTRACTOR_CACHE_MB", 500)) * 2 ** 20)
+# When set, entries are never read, only replaced by fresh results.
+_refresh = False
+
+
+def set_refresh(refresh=True):
+    """Ignore cached results from now on, e.g. for a --refresh flag."""
+    global _refresh
+    _refresh = refresh
+
+
+def refreshing():
+    """Return True if cached results are being ignored."""
+    return _refresh
+
+
+def key(name, digest, params, kwargs):
+    """Return the cache key for a query run with params and kwargs."""
+    identity = repr((name, digest, list(params), sorted(kwargs.items())))
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+
+def cache_path(key):
+    """Return where the entry for key is kept."""
+    return os.path.join(_cache_dir, key + ".pkl.gz")
+
+
+def load(key, ttl=None):
+    """Return the cached DataFrame for key, or None if there is none.
+
+    Entries older than ttl (default: _ttl) count as missing, as does
+    every entry while refreshing, or one deleted while being read.
+    """
+    if ttl is None:
+        ttl = _ttl
+    path = cache_path(key)
+    if _refresh or not os.path.exists(path):
+        return None
+    try:
+        fetched = os.path.getmtime(path)
+        if time.time() - fetched >= ttl.total_seconds():
+            return None
+        df = pd.read_pickle(path)
+        # The access time marks when an entry was last used; the
+        # modification time still says when it was fetched.
+        os.utime(path, (time.time(), fetched))
+    except (OSError, EOFError):
+        # evict() in another thread or process got to it first.
+        return None
+    return df
+
+
+def save(key, df):
+    """Cache df under key, then trim the cache back to its budget."""
+    os.makedirs(_cache_dir, exist_ok=True)
+    path = cache_path(key)
+    # Write beside the entry and swap it in, so no reader ever sees half
+    # a file.
+    partial = "{}.{}.tmp".format(path, threading.get_ident())
+    df.to_pickle(partial, compression="gzip")
+    os.replace(partial, path)
+    evict()
+
+
+def evict(budget=None):
+    """Delete entries until the cache fits in budget bytes.
+
+    Expired entries go first, then the least recently used.
+    """
+    if budget is None:
+        budget = _budget
+    entries = []
+    for name in os.listdir(_cache_dir):
+        if not name.endswith(".pkl.gz"):
+            continue
+        path = os.path.join(_cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Another thread got to it first.
+            continue
+        expired = time.time() - stat.st_mtime >= _ttl.total_seconds()
+        entries.append((not expired, stat.st_atime, stat.st_size, path))
+    total = sum(entry[2] for entry in entries)
+    for fresh, used, size, path in sorted(entries):
+        if fresh and total <= budget:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total = total - size
@@ -0,0 +1,46 @@
+"""Run independent SQL queries side by side on a bounded thread pool."""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import queries
+
+# How many queries may run against the database at once. Keep this low;
+# every worker holds its own connection to the production server.
+_max_workers = int(os.environ.get("EXTRACTOR_DB_WORKERS", 4))
+
+
+def read_query(connect, query, params, kwargs):
+    """Open a connection, run one query into a DataFrame and close it."""
+    cnxn = connect()
+    try:
+        return queries.read(query, cnxn, params, **kwargs)
+    finally:
+        cnxn.close()
+
+
+def run_queries(jobs, connect, max_workers=None, calls=None):
+    """Run every query at once and return their DataFrames by name.
+
+    jobs -- dict of name -> (registered query, parameters, keyword
+        arguments for pd.read_sql)
+    connect -- function returning a new DB-API connection, e.g.
+        connection_pool.setup_FTP
+    max_workers -- most queries in flight at once (default:
+        EXTRACTOR_DB_WORKERS from the environment, or 4)
+    calls -- other database work to run in the same pool, as a dict
+        of name -> (function, arguments, keyword arguments); their
+        return values come back under their names after the jobs'
+
+    The returned dict keeps the order of jobs, whatever order the
+    queries finish in, so sheets can still be written deterministically.
+    """
+    if max_workers is None:
+        max_workers = _max_workers
+    calls = dict(calls or {})
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {
+            name: pool.submit(read_query, connect, query, params, kwargs)
+            for name, (query, params, kwargs) in jobs.items()}
+        futures.update({
+            name: pool.submit(function, *args, **kwargs)
+            for name, (function, args, kwargs) in calls.items()})
+        return {name: future.result() for name, future in futures.items()}
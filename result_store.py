@@ -0,0 +1,398 @@
+"""Local store of district test result facts, kept current by watermark.
+
+The first sync of a query copies every row it returns into a per-district
+SQLite file. Later syncs only ask the server for results whose
+UpdatedDate is past the newest one stored, less _overlap, plus the list
+of result IDs that still exist, and merge the difference in. The
+overlap catches rows that committed late with an earlier UpdatedDate;
+results fetched again unchanged are left alone. The ID list is a scan
+of the district's whole history, so the syncs of one run share a single
+fetch of it through result_ids().
+
+Each sync of a query has a generation number, and every row it stores
+is tagged with it in a _generation column. Readers asking for what is
+new go by generation rather than by date, so late rows are never
+missed. Loads are staged in a side table and swapped in within one
+transaction, so no reader ever sees a table half synced.
+
+Delta exports keep their own generation per query, apart from the sync
+one, so a sync made for any other reason never hides rows from the next
+delta. It only moves once the delta file has been written.
+
+A synced query must:
+- start with "declare @since datetime = ?" and filter on
+  tr.UpdatedDate > @since, so one query text serves full and delta
+  fetches;
+- return TestResultID and UpdatedDate columns.
+"""
+import datetime as dt
+import os
+import os.path
+import sqlite3
+import threading
+import pandas as pd
+import queries
+
+_store_dir = os.path.join(os.getcwd(), "Cache", "Results")
+# Passed as @since to fetch everything.
+_beginning = dt.datetime(1900, 1, 1)
+# How far below the watermark each incremental sync looks again.
+_overlap = dt.timedelta(hours=1)
+# Column tagging each stored row with the sync that brought it in.
+_generation = "_generation"
+# Rows the extracts read back from a store at a time, unless told
+# otherwise, so big districts stay in bounded memory from the GUI too.
+_chunksize = int(os.environ.get("EXTRACTOR_CHUNKSIZE", 50000))
+
+# Every test result that still belongs to the district, by any of the
+# routes the extracts use to tie a result to one.
+_result_ids = queries.register("store.result_ids", """
+declare @district int = ?
+
+select tr.TestResultID from TestResult tr with (nolock)
+join School sch with (nolock) on sch.SchoolID = tr.SchoolID
+where sch.DistrictID = @district
+union
+select tr.TestResultID from TestResult tr with (nolock)
+join [User] u with (nolock) on u.UserID = tr.UserID
+where u.DistrictID = @district
+union
+select tr.TestResultID from TestResult tr with (nolock)
+join DistrictTerm dt with (nolock) on
+dt.DistrictTermID = tr.DistrictTermID
+where dt.DistrictID = @district
+""")
+
+
+def store_path(districtID):
+    """Return the SQLite file holding a district's synced results."""
+    return os.path.join(_store_dir, "{}.sqlite".format(int(districtID)))
+
+
+def connect_store(districtID):
+    """Open the district's store, creating it if needed."""
+    # Several syncs may get here at once.
+    os.makedirs(_store_dir, exist_ok=True)
+    store = sqlite3.connect(store_path(districtID), timeout=60)
+    store.execute("""create table if not exists watermarks (
+        name text primary key, digest text, params text,
+        watermark text, synced text)""")
+    if "generation" not in table_columns(store, "watermarks"):
+        store.execute(
+            "alter table watermarks add column generation integer")
+    store.execute("""create table if not exists exports (
+        name text primary key, digest text, params text,
+        watermark text, exported text)""")
+    return store
+
+
+def has_table(store, table):
+    """Return True if the store has a table called table."""
+    return store.execute(
+        "select 1 from sqlite_master where type = 'table' and name = ?",
+        [table]).fetchone() is not None
+
+
+def table_columns(store, table):
+    """Return the names of a store table's columns, [] if it has none."""
+    return [row[1] for row in
+            store.execute("pragma table_info([{}])".format(table))]
+
+
+def table_name(query):
+    """Return the store table a registered query syncs into."""
+    return query.name.replace(".", "_")
+
+
+def result_ids(districtID):
+    """Return a function fetching the district's current result IDs once.
+
+    Pass it as ids to every sync of one run. The first incremental sync
+    to need the IDs fetches them through its connection; the rest reuse
+    them. A result created after the fetch is still kept, because
+    merge() adds the delta after dropping deleted results.
+    """
+    lock = threading.Lock()
+    fetched = []
+
+    def ids(cnxn):
+        """Return the IDs, fetching them through cnxn the first time."""
+        with lock:
+            if not fetched:
+                fetched.append(queries.read(
+                    _result_ids, cnxn, [int(districtID)], cache=False))
+            return fetched[0]
+    return ids
+
+
+def sync(query, districtID, params, connect, chunksize=50000,
+         parse_dates=None, ids=None):
+    """Bring the stored copy of a query up to date.
+
+    query -- a registered query following the rules in this module's
+        docstring
+    params -- the query's parameters, after @since
+    connect -- function returning a new connection to the server
+    parse_dates -- date columns to parse, as for pd.read_sql
+    ids -- function from result_ids(), shared by the syncs of one run,
+        or False to leave deleted results in place until a later sync
+        (default: fetch the IDs for this sync alone)
+
+    Returns the generation synced from, to pass to read() as since to
+    get only what this sync brought in. That is None on a first or
+    full sync, when every row was fetched.
+    """
+    table = table_name(query)
+    params = list(params)
+    parse_dates = ['UpdatedDate'] + list(parse_dates or [])
+    # Two syncs of one query, e.g. from two batch processes, each
+    # stage their own rows.
+    staging = "{}__staging_{}_{}".format(table, os.getpid(),
+                                         threading.get_ident())
+    store = connect_store(districtID)
+    cnxn = connect()
+    try:
+        row = store.execute(
+            "select digest, params, watermark, generation from watermarks "
+            "where name = ?", [query.name]).fetchone()
+        # Tables stored before rows carried a generation are reloaded.
+        full = (row is None or row[:2] != (query.digest, repr(params))
+                or row[3] is None)
+        previous = None if row is None or row[3] is None else int(row[3])
+        generation = (previous or 0) + 1
+        watermark = pd.Timestamp(_beginning if full else row[2])
+        since = _beginning if full else (
+            watermark - _overlap).to_pydatetime()
+        store.execute("drop table if exists [{}]".format(staging))
+        if full:
+            frames = queries.read_chunks(
+                query, cnxn, [since] + params, chunksize,
+                parse_dates=parse_dates)
+        else:
+            delta = queries.read(query, cnxn, [since] + params,
+                                 cache=False, parse_dates=parse_dates)
+            frames = [changed_rows(store, table, delta)]
+        for df in frames:
+            df.assign(**{_generation: generation}).to_sql(
+                staging, store, if_exists='append', index=False)
+            if not df.empty:
+                watermark = max(watermark, df.UpdatedDate.max())
+        if not full and ids is None:
+            ids = result_ids(districtID)
+        current = ids(cnxn) if ids and not full else None
+        # Everything from here on lands at once, or not at all. Take the
+        # write lock up front: two syncs that both read first and then
+        # tried to write would deadlock, and SQLite fails one at once.
+        store.execute("begin immediate")
+        if full:
+            store.execute("drop table if exists [{}]".format(table))
+            if has_table(store, staging):
+                store.execute("alter table [{}] rename to [{}]".format(
+                    staging, table))
+        else:
+            merge(store, table, staging, current)
+        store.execute(
+            "insert or replace into watermarks "
+            "(name, digest, params, watermark, synced, generation) "
+            "values (?, ?, ?, ?, ?, ?)",
+            [query.name, query.digest, repr(params), str(watermark),
+             str(dt.datetime.now()), generation])
+        store.commit()
+    finally:
+        if store.in_transaction:
+            store.rollback()
+        store.execute("drop table if exists [{}]".format(staging))
+        cnxn.close()
+        store.close()
+    return None if full else previous
+
+
+def changed_rows(store, table, delta):
+    """Return delta less the results stored already, unchanged.
+
+    The overlap below the watermark brings back results synced before.
+    A result counts as unchanged if its newest UpdatedDate is the one
+    stored.
+    """
+    if delta.empty or not has_table(store, table):
+        return delta
+    fetched = delta.groupby('TestResultID').UpdatedDate.max()
+    store.execute("create temp table if not exists fetched_ids "
+                  "(TestResultID integer primary key)")
+    store.execute("delete from fetched_ids")
+    store.executemany("insert into fetched_ids values (?)",
+                      [(int(value),) for value in fetched.index])
+    stored = pd.read_sql(
+        "select TestResultID, max(UpdatedDate) as UpdatedDate from [{}] "
+        "where TestResultID in (select TestResultID from fetched_ids) "
+        "group by TestResultID".format(table),
+        store, parse_dates=['UpdatedDate']).set_index(
+            'TestResultID').UpdatedDate
+    store.commit()
+    same = fetched.index[fetched.eq(stored.reindex(fetched.index))]
+    return delta[~delta.TestResultID.isin(same)]
+
+
+def pending_export(query, districtID, params):
+    """Return (since, until) bounding the rows a delta export should hold.
+
+    Both are sync generations; pass them to read(). since is None if
+    this query, with these params, has never been exported, so every
+    stored row is pending. until is the latest sync's, so rows synced
+    while the export is being written wait for the next one. Call after
+    sync().
+    """
+    params = list(params)
+    store = connect_store(districtID)
+    try:
+        synced = store.execute(
+            "select generation from watermarks where name = ?",
+            [query.name]).fetchone()
+        exported = store.execute(
+            "select digest, params, watermark from exports where name = ?",
+            [query.name]).fetchone()
+    finally:
+        store.close()
+    until = synced[0] if synced else None
+    if (exported is None or exported[:2] != (query.digest, repr(params))
+            or not str(exported[2]).isdigit()):
+        # Exports recorded by date, before generations, start over too.
+        return None, until
+    return int(exported[2]), until
+
+
+def mark_exported(query, districtID, params, until):
+    """Record that rows up to generation until have been exported.
+
+    Call only once the delta file is safely written, with the until
+    pending_export() returned.
+    """
+    if until is None:
+        return
+    store = connect_store(districtID)
+    try:
+        store.execute(
+            "insert or replace into exports values (?, ?, ?, ?, ?)",
+            [query.name, query.digest, repr(list(params)), str(until),
+             str(dt.datetime.now())])
+        store.commit()
+    finally:
+        store.close()
+
+
+def merge(store, table, staging, ids):
+    """Apply a staged delta and the current result IDs to a table.
+
+    Rows for every result in the staging table replace the stored ones,
+    since a changed result comes back with all of its rows. Rows for
+    results no longer in ids have been deleted on the server and are
+    dropped; pass ids=None to skip that check. Call inside a
+    transaction.
+    """
+    if not has_table(store, table):
+        store.execute("alter table [{}] rename to [{}]".format(
+            staging, table))
+        return
+    # Temporary tables belong to this connection alone, so queries
+    # syncing into the same store at once can't see each other's.
+    temps = ["changed_ids"] + (["current_ids"] if ids is not None else [])
+    for name in temps:
+        store.execute("create temp table if not exists {} "
+                      "(TestResultID integer primary key)".format(name))
+        store.execute("delete from {}".format(name))
+    store.execute("insert or ignore into changed_ids "
+                  "select TestResultID from [{}]".format(staging))
+    sql = ("delete from [{}] where TestResultID in "
+           "(select TestResultID from changed_ids)".format(table))
+    if ids is not None:
+        store.executemany("insert or ignore into current_ids values (?)",
+                          [(int(value),) for value in ids.TestResultID])
+        sql = sql + (" or TestResultID not in "
+                     "(select TestResultID from current_ids)")
+    store.execute(sql)
+    names = ", ".join("[{}]".format(name)
+                      for name in table_columns(store, staging))
+    store.execute("insert into [{}] ({}) select {} from [{}]".format(
+        table, names, names, staging))
+
+
+def chunk_rows(chunksize=None):
+    """Return the chunksize an extract should read() with.
+
+    chunksize -- rows at a time, 0 to read whole (default:
+        EXTRACTOR_CHUNKSIZE from the environment, or 50000)
+    """
+    if chunksize is None:
+        chunksize = _chunksize
+    return chunksize or None
+
+
+def read(query, districtID, chunksize=None, order_by=None,
+         parse_dates=None, since=None, until=None, columns=None):
+    """Read a synced query's rows back out of the district's store.
+
+    chunksize -- yield DataFrames of this many rows instead of one
+    order_by -- SQL order by clause, e.g. "UpdatedDate desc"
+    since -- only rows synced after this generation, e.g. what sync()
+        returned
+    until -- only rows synced up to this generation, e.g. from
+        pending_export()
+    columns -- only read these columns (default: all of them)
+
+    Rows come back converted to the query's compact schema.
+    """
+    table = table_name(query)
+    store = connect_store(districtID)
+    if not has_table(store, table):
+        # The query has never returned a row for this district.
+        store.close()
+        return pd.DataFrame() if chunksize is None else []
+    if not columns:
+        columns = [column for column in table_columns(store, table)
+                   if column != _generation]
+    sql = "select {} from [{}]".format(
+        ", ".join("[{}]".format(column) for column in columns), table)
+    bounds = [(since, ">"), (until, "<=")]
+    params = [int(value) for value, _ in bounds if value is not None]
+    where = ["[{}] {} ?".format(_generation, operator)
+             for value, operator in bounds if value is not None]
+    if where:
+        sql = sql + " where " + " and ".join(where)
+    if order_by:
+        sql = sql + " order by " + order_by
+    parse_dates = ['UpdatedDate'] + list(parse_dates or [])
+    if chunksize is None:
+        try:
+            df = pd.read_sql(sql, store, params=params,
+                             parse_dates=parse_dates)
+        finally:
+            store.close()
+        df, before, after = queries.compact(query, df)
+        print("{} [{}]: {} rows from store{}".format(
+            query.name, query.digest, len(df),
+            queries.savings(before, after)))
+        return df
+    return _read_chunks(query, store, sql, params, chunksize, parse_dates)
+
+
+def _read_chunks(query, store, sql, params, chunksize, parse_dates):
+    """Yield compact chunks of a store query, closing the store after."""
+    before = after = 0
+    try:
+        for df in pd.read_sql(sql, store, params=params,
+                              chunksize=chunksize, parse_dates=parse_dates):
+            if df.empty:
+                # pandas skips parse_dates on an empty chunk, and the
+                # sheets' date handling needs real date columns.
+                df = df.astype({column: 'datetime64[ns]'
+                                for column in parse_dates
+                                if column in df.columns})
+            df, chunk_before, chunk_after = queries.compact(query, df)
+            if chunk_before is not None:
+                before, after = before + chunk_before, after + chunk_after
+            yield df
+    finally:
+        store.close()
+    print("{} [{}]: streamed from store{}".format(
+        query.name, query.digest,
+        queries.savings(before, after) if before else ""))
@@ -0,0 +1,121 @@
+"""Write DataFrames straight to .xlsx without launching Excel."""
+import datetime as dt
+import itertools
+import os
+import os.path
+import pandas as pd
+import xlsxwriter
+
+# Excel's own AutoFit tops out around here, so we do too.
+_max_width = 60
+
+
+def fit_width(length):
+    """Return the column width that fits text of length characters."""
+    return min(length + 2, _max_width)
+
+
+def column_widths(df):
+    """Return a list of column widths that fit the header and data."""
+    widths = []
+    for column in df.columns:
+        width = len(str(column))
+        lengths = df[column].dropna().astype(str).str.len()
+        if not lengths.empty:
+            width = max(width, int(lengths.max()))
+        widths.append(fit_width(width))
+    return widths
+
+
+def cell_values(df):
+    """Yield each row of df as a tuple with missing values as None."""
+    df = df.astype(object).where(pd.notna(df), None)
+    return df.itertuples(index=False, name=None)
+
+
+def write_rows(worksheet, df, first_row):
+    """Write the rows of df to worksheet starting at first_row."""
+    for row, values in enumerate(cell_values(df), start=first_row):
+        worksheet.write_row(row, 0, values)
+    return first_row + len(df)
+
+
+def add_sheet(workbook, name, df, header_format=None):
+    """Add a worksheet to workbook holding df, sized to fit its data."""
+    worksheet = workbook.add_worksheet(name)
+    for col, width in enumerate(column_widths(df)):
+        worksheet.set_column(col, col, width)
+    worksheet.write_row(0, 0, [str(c) for c in df.columns], header_format)
+    write_rows(worksheet, df, 1)
+    return worksheet
+
+
+def stream_sheet(workbook, name, frames, header_format=None,
+                 skip_empty=False, columns=None):
+    """Add a worksheet built from an iterable of DataFrames, in order.
+
+    Each frame is written and dropped before the next is read, so a
+    chunked query never has to fit in memory at once. The header and
+    column widths come from the first frame.
+
+    skip_empty -- leave the sheet out entirely if no rows come back
+    columns -- header to write if no frame comes back at all
+    """
+    worksheet = None
+    row = 1
+    for df in frames:
+        if worksheet is None:
+            if skip_empty and df.empty:
+                continue
+            worksheet = add_sheet(workbook, name, df, header_format)
+            row = row + len(df)
+        else:
+            row = write_rows(worksheet, df, row)
+    if worksheet is None and not skip_empty:
+        worksheet = add_sheet(workbook, name,
+                              pd.DataFrame(columns=columns or []),
+                              header_format)
+    return worksheet
+
+
+def open_workbook(path):
+    """Return a constant_memory workbook for path, making its folder.
+
+    In constant_memory mode xlsxwriter flushes each row to disk as soon
+    as the next one starts, so every sheet must be written top to
+    bottom.
+    """
+    loc = os.path.split(path)[0]
+    if loc:
+        os.makedirs(loc, exist_ok=True)
+    return xlsxwriter.Workbook(path, {
+        'constant_memory': True,
+        'default_date_format': 'mm/dd/yyyy'})
+
+
+def stamped_path(stem):
+    """Return stem + the date and time + ".xlsx", for a file made once.
+
+    Used for files that must never replace an earlier one, e.g. delta
+    extracts. If the name is somehow taken already, it gets a number.
+    """
+    stamp = dt.datetime.now().strftime("%Y-%m-%d %H%M%S")
+    for number in itertools.count(1):
+        path = "{} {}{}.xlsx".format(
+            stem, stamp, "" if number == 1 else " ({})".format(number))
+        if not os.path.exists(path):
+            return path
+
+
+def write_sheets(path, sheets):
+    """Save a sheet name -> DataFrame dict to path as one workbook.
+
+    Rows are streamed out in order with xlsxwriter's constant_memory
+    mode, so this runs headless and needs no Excel installation.
+    """
+    workbook = open_workbook(path)
+    header = workbook.add_format({'bold': True})
+    for name, df in sheets.items():
+        add_sheet(workbook, name, df, header)
+    workbook.close()
+    return path
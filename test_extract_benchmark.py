@@ -0,0 +1,36 @@
+"""Checks for the Benchmark extract's vectorized term and date columns."""
+import datetime as dt
+import pandas as pd
+import extract_benchmark
+
+
+def test_clean_terms():
+    names = pd.Series([
+        "2017-18", "2016-2017", "17-18", "2016-17 S2", "Fall",
+        "Grade 10-11 Review", "Gr 9-10", "Spring 2018-19", "Room 12-14",
+        "Grade 3-4 2019-20", None])
+    dates = pd.Series(pd.to_datetime([
+        "2018-01-05", "2017-03-01", "2018-02-01", "2017-01-01",
+        "2017-09-01", "2018-10-01", "2016-10-01", "2019-03-01",
+        "2017-02-01", "2019-11-01", "2016-05-01"]))
+    # Names without a school year, or with a grade span that only looks
+    # like one, fall back to the year the result date falls in.
+    expected = ["2017-18", "2016-17", "2017-18", "2016-17", "2017-18",
+                "2018-19", "2016-17", "2018-19", "2016-17", "2019-20",
+                "2015-16"]
+    assert list(extract_benchmark.clean_terms(names, dates)) == expected
+
+
+def test_terms_from_dates_boundary():
+    dates = pd.Series([dt.datetime(2017, 7, 30), dt.datetime(2017, 7, 31)])
+    assert list(extract_benchmark.terms_from_dates(dates)) == [
+        "2016-17", "2017-18"]
+
+
+def test_form_letters_and_short_dates():
+    names = pd.Series(["LinkIt Form B Math", "LinkIt Form C", "Other"])
+    assert list(extract_benchmark.form_letters(names)) == ["B", "C", " "]
+    dates = pd.Series(pd.to_datetime(
+        ["2018-01-05 13:00", "2017-10-20 00:00"]))
+    assert list(extract_benchmark.short_dates(dates)) == [
+        "1/5/2018", "10/20/2017"]
@@ -0,0 +1,73 @@
+"""Regression tests for the PARCC extract's vectorized sheet columns.
+
+The expected values are what the old per-group loop (NUM, DIV) and
+row-by-row apply calls (Year, NAVGrade) gave for the same rows.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import extract_parcc
+
+_alg1 = "2017-2018 PARCC Alg I"
+_alg2 = "2016-2017 PARCC Alg II"
+_geo = "2015-2016 PARCC Geo"
+
+
+def cluster_frame(categorical):
+    """Return Cluster sheet rows covering the edge cases."""
+    df = pd.DataFrame({
+        'TestName': [_alg1, _alg1, _alg1, _alg1, _alg1, _alg1, _alg1,
+                     _alg1, _alg2, _geo],
+        'School': [1, 1, 1, 1, 1, 1, 2, None, 1, 1],
+        'ClusterName': ['Scale Score', 'Scale Score', 'Scale Score',
+                        'Major Content', 'Major Content', 'Major Content',
+                        'Major Content', 'Major Content', 'Scale Score',
+                        'Reasoning'],
+        'Score': [700, 750, np.nan, 1, 0, 1, 1, 1, 720, np.nan],
+    })
+    if categorical:
+        # As the compact schema reads them back from the store.
+        for column in ['TestName', 'ClusterName']:
+            df[column] = df[column].astype('category')
+    return df
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+def test_cluster_totals(categorical):
+    cluster = extract_parcc.cluster_totals(cluster_frame(categorical))
+    # Scale Score sums scores, skipping the missing one; other clusters
+    # count the scores of 1. The row with no school gets no totals.
+    expected_num = [1450, 1450, 1450, 2, 2, 2, 1, np.nan, 720, 0]
+    expected_div = [2, 2, 2, 3, 3, 3, 1, np.nan, 1, 0]
+    pd.testing.assert_series_equal(
+        cluster.NUM, pd.Series(expected_num, name='NUM'), check_dtype=False)
+    pd.testing.assert_series_equal(
+        cluster.DIV, pd.Series(expected_div, name='DIV'), check_dtype=False)
+
+
+def test_score_rows():
+    score = pd.DataFrame({
+        'TestName': [_alg1, _alg2, _geo, "2017-2018 PARCC ELA 3",
+                     "2017-2018 PARCC Math 5", "2017-2018 PARCC N/A 4"],
+        'Subject': ['Math', 'Math', 'Math', 'Language Arts', 'Math',
+                    'Math'],
+        'Grade': ['8', '10', '9', '3', '5', '4'],
+        'SchoolID': [1, 1, 2, None, 2, 1],
+        'StudentID': [1, 2, 3, 4, 5, 6],
+        'StudentCode': 'c', 'StudentFirstName': 'f',
+        'StudentLastName': 'l',
+        'ScaledScore': [700, 710, 720, 730, 740, 750],
+        'ProfLevel': '3',
+    })
+    rows = extract_parcc.score_rows(score)
+    assert list(rows.Year) == ['2018', '2017', '2016', '2018', '2018']
+    assert list(rows.NAVGrade) == [9, 11, 10, '3', '5']
+    assert list(rows.Subject) == ['Math', 'Math', 'Math', 'ELA', 'Math']
+
+
+def test_score_rows_empty():
+    score = pd.DataFrame(columns=[
+        'TestName', 'Subject', 'Grade', 'SchoolID', 'StudentID',
+        'StudentCode', 'StudentFirstName', 'StudentLastName',
+        'ScaledScore', 'ProfLevel'])
+    assert extract_parcc.score_rows(score).empty
@@ -2,20 +2,71 @@
 import pandas as pd
 import os.path
 import datetime as dt
+from collections import namedtuple
 from datetime import timedelta as td
-import win32com.client as win32
-import mal_data as mal
-
-
-def setup_dest_file(path):
-    """Make writer for excel file."""
-    loc = os.path.split(path)[0]
-    if not os.path.exists(loc):
-        os.makedirs(loc)
-    writer = pd.ExcelWriter(path, 'xlsxwriter',
-                            datetime_format='mm/dd/yyyy hh:mm:ss',
-                            date_format='mm/dd/yyyy')
-    return writer
+from xlsxwriter.utility import xl_col_to_name
+import connection_pool
+import sheet_writer
+import usage_rollup
+
+
+# Districts and district groups left out of the "Without BEC, A Beka,
+# A List, CEE, Frog Street" table, along with Frog Street's districts,
+# which are found by name.
+_a_beka = 2479
+_partner_districts = [2680, _a_beka]
+_bec = 112
+_partner_groups = [_bec, 114]
+_frog_street = 'frog street'
+# Online test session statuses, in the order the report lists them.
+_statuses = [(1, '# of Created'), (2, '# of Started'), (3, '# of Paused'),
+             (5, '# of Pending Review'), (4, '# of Completed')]
+# Hours to add to server times to get the report's.
+_hour_shift = -4
+
+# Where each table goes, and what goes around it. Each week's copy of a
+# table sits step columns right of the week before's.
+# row -- row of the table's header
+# label -- rows above the header to name the week (default: 1)
+# caption -- bold text in the row above the header
+# totals -- columns to sum in a Total row, 8 rows below the header
+# change -- add This Week's change from Last Week's and Last Year's
+#     totals, below the Total row
+# title -- text over This Week's copy, 2 rows above the header
+# banner -- purple text across This Week's copy, 2 rows above the header
+# first_row_bold -- make the first row under the header bold
+# formats -- column -> style name for the whole column
+_sections = {
+    '1A': {'sheet': "# of Results by Date", 'row': 1, 'step': 5,
+           'totals': ['Total', 'OnlineTests', 'BubbleSheets'],
+           'change': True},
+    '1B': {'sheet': "# of Results by Date", 'row': 17, 'step': 5,
+           'totals': ['Total', 'OnlineTests', 'BubbleSheets'],
+           'change': True,
+           'banner': "Without BEC, A Beka, A List, CEE, Frog Street"},
+    '2': {'sheet': "# of Results by Client", 'row': 1, 'step': 7,
+          'formats': {'%': 'percent'}},
+    '3': {'sheet': "# of LinkIt Benchmarks", 'row': 1, 'step': 6,
+          'first_row_bold': True},
+    '4A': {'sheet': "# of Online by Date", 'row': 2, 'step': 8,
+           'label': 2, 'caption': "By Start Date"},
+    '4B': {'sheet': "# of Online by Date", 'row': 14, 'step': 8,
+           'label': 2, 'caption': "By Last Login Date"},
+    '5': {'sheet': "# of Online by Hour", 'row': 2, 'step': 11,
+          'label': 2, 'caption': "By Last Login Date",
+          'formats': dict.fromkeys([
+              '% of A Beka', '% of BEC', '% of Frog Street', '% of Others'],
+              'whole percent')},
+    '6A': {'sheet': "# of Data Locker", 'row': 2, 'step': 4,
+           'totals': ['Total'], 'title': "By Date"},
+    '6B': {'sheet': "# of Data Locker", 'row': 14, 'step': 4,
+           'title': "By Client"},
+}
+# How values in a column of each percent style look, to size it by.
+_shown = {'percent': '{:.2%}', 'whole percent': '{:.0%}'}
+# Column widths set by hand, by sheet. Column A of the first sheet
+# leaves room for the week labels without fitting the purple banner.
+_fixed_widths = {"# of Results by Date": {0: 15}}
 
 
 def last_friday(d):
@@ -68,18 +119,244 @@ def fill_dates(df, week):
     return df
 
 
-def sql_week(s, week):
-    """Add variable declarations to beginning of a SQL query."""
-    return """Declare @weekstart datetime, @weekend datetime
-    set @weekstart='"""+str(week[0])+"""'
-    set @weekend='"""+str(week[1])+"'" + s
+def week_days(week):
+    """Return every day from a week's start up to its end."""
+    return [week[0] + td(days=day) for day in range((week[1] - week[0]).days)]
+
+
+def tally(keys, counts, count):
+    """Sum count by keys, once for each entry of counts.
+
+    keys -- output column name -> Series to group by
+    counts -- output column name -> mask of the rows it counts
+    Returns a row for each keys with anything counted, sorted by keys.
+    """
+    counted = pd.concat(list(counts.values()), axis=1).any(axis=1)
+    table = pd.DataFrame({name: count.where(mask, 0)[counted]
+                          for name, mask in counts.items()})
+    groups = [series[counted].rename(name) for name, series in keys.items()]
+    return table.groupby(groups).sum().reset_index()
+
+
+def section_tables(rows):
+    """Build every table in the report from one week's rollup rows.
+
+    Returns a dict of part of the report (e.g. '1A') -> DataFrame.
+    """
+    source = rows.Source
+    tests = source == 'result'
+    online, bubble = tests & (rows.Online == 1), tests & (rows.Bubble == 1)
+    result = online | bubble
+    locker = tests & (rows.DataLocker == 1)
+    started, login = source == 'session start', source == 'session login'
+    day = rows.Date.dt.strftime('%m/%d/%Y')
+    client = {'State': rows.State, 'District': rows.District}
+    frog_street = rows.District.str.contains(
+        _frog_street, case=False, regex=False, na=True)
+    # Districts outside any group don't pass "not in" on the server.
+    partner = (rows.DistrictID.isin(_partner_districts)
+               | rows.DistrictGroupID.isna()
+               | rows.DistrictGroupID.isin(_partner_groups) | frog_street)
+    linkit = rows.LinkIt == 1
+
+    def results(names, mask=True):
+        """Count results, online and bubble sheet tests under names."""
+        return dict(zip(names, [result & mask, online & mask,
+                                bubble & mask]))
+
+    def sessions(mask):
+        """Count every session and each status in mask."""
+        counts = {'Total # of Online Tests': mask}
+        for status, name in _statuses:
+            counts[name] = mask & (rows.Status == status)
+        return counts
+
+    def biggest(table, column):
+        """Sort table by column, biggest first."""
+        return table.sort_values(column, ascending=False, kind='stable',
+                                 ignore_index=True)
+
+    hour = (rows.Date + pd.to_timedelta(rows.Hour + _hour_shift, unit='h')
+            ).dt.strftime('%Y-%m-%d %H')
+    by_client = ['TotalResults', 'OnlineTests', 'BubbleSheets']
+    by_date = ['Total', 'OnlineTests', 'BubbleSheets']
+    tables = {
+        '1A': tally({'Date': day}, results(by_date), rows.Count),
+        '1B': tally({'Date': day}, results(by_date, ~partner), rows.Count),
+        '2': biggest(tally(client, results(by_client), rows.Count),
+                     'TotalResults'),
+        '3': biggest(tally(client, results(by_client, linkit), rows.Count),
+                     'TotalResults'),
+        '4A': tally({'Date Started': day}, sessions(started), rows.Count),
+        '4B': tally({'Date Last Log In': day}, sessions(login), rows.Count),
+        '5': biggest(tally({'Hour': hour}, {
+            'Number of Sessions': login,
+            'A Beka': login & (rows.DistrictID == _a_beka),
+            'BEC': login & (rows.DistrictGroupID == _bec),
+            'Frogstreet': login & frog_street}, rows.Count),
+            'Number of Sessions'),
+        '6A': tally({'Date': day}, {'Total': locker}, rows.Count),
+        '6B': biggest(tally(client, {'Total': locker}, rows.Count), 'Total'),
+    }
+    # Each client's share of the week's results
+    df = tables['2']
+    df['%'] = df['TotalResults'] / df['TotalResults'].sum()
+    # A Total row at the top
+    df = tables['3']
+    tables['3'] = pd.concat([pd.DataFrame(
+        [['Total', '', df['TotalResults'].sum(), df['OnlineTests'].sum(),
+          df['BubbleSheets'].sum()]], columns=df.columns), df],
+        ignore_index=True)
+    # Sessions outside the three named clients, and everyone's share
+    df = tables['5']
+    df['Others'] = (df['Number of Sessions']
+                    - (df['A Beka'] + df['BEC'] + df['Frogstreet']))
+    df['% of A Beka'] = df['A Beka'] / df['Number of Sessions']
+    df['% of BEC'] = df['BEC'] / df['Number of Sessions']
+    df['% of Frog Street'] = df['Frogstreet'] / df['Number of Sessions']
+    df['% of Others'] = df['Others'] / df['Number of Sessions']
+    return tables
+
+
+# A run of rows placed on a sheet, from its first cell's row and column.
+# style -- name of the format for every cell in it, if any
+# fit -- whether column widths are sized to fit its cells
+# shown -- column in the block -> format string, for values Excel shows
+#     other than as str() does, e.g. percentages
+Block = namedtuple("Block", ["row", "col", "rows", "style", "fit", "shown"],
+                   defaults=(None, True, None))
+
+
+def section_blocks(spec, col, df, first):
+    """Return the blocks for one week's copy of a table, in write order.
+
+    spec -- the table's entry in _sections
+    col -- column the copy starts in
+    first -- whether this is This Week's copy, the leftmost
+    """
+    row = spec['row']
+    shown = {df.columns.get_loc(column): _shown[style]
+             for column, style in spec.get('formats', {}).items()}
+    blocks = [Block(row + 1, col, list(sheet_writer.cell_values(df)),
+                    shown=shown),
+              Block(row, col, [list(df.columns)], 'header'),
+              Block(row - spec.get('label', 1), col, [[spec['week']]],
+                    'week')]
+    if 'caption' in spec:
+        blocks.append(Block(row - 1, col, [[spec['caption']]], 'header'))
+    if 'totals' in spec:
+        totals = row + 8
+        blocks.append(Block(totals, col, [
+            ['Total'] + [df[column].sum() for column in spec['totals']]],
+            'header'))
+        if spec.get('change') and first:
+            # Compare This Week's totals with Last Week's and Last Year's
+            # copies, which sit one and two steps to the right.
+            changes = []
+            for label, step in [("Weekly Change", spec['step']),
+                                ("Yearly Change", 2 * spec['step'])]:
+                cells = [label]
+                for offset in range(1, len(spec['totals']) + 1):
+                    now = xl_col_to_name(col + offset)
+                    then = xl_col_to_name(col + offset + step)
+                    cells.append("=({0}{2}-{1}{2})/{1}{2}".format(
+                        now, then, totals + 1))
+                changes.append(cells)
+            blocks.append(Block(totals + 2, col, changes, 'header percent',
+                                fit=False))
+    if 'title' in spec and first:
+        blocks.append(Block(row - 2, col, [[spec['title']]], 'week'))
+    return blocks
+
+
+def layout(tables):
+    """Place every week's tables, returning the report sheet by sheet.
+
+    tables -- week name -> part of the report -> DataFrame, weeks in
+        report order, left to right
+
+    Returns a dict of sheet name -> (blocks in write order, column ->
+    style name, row -> style name). Where blocks overlap, later ones win.
+    """
+    sheets = {}
+    banners = []
+    for index, (week, parts) in enumerate(tables.items()):
+        for part, spec in _sections.items():
+            spec = dict(spec, week=week)
+            df = parts[part]
+            col = index * spec['step']
+            blocks, col_styles, row_styles = sheets.setdefault(
+                spec['sheet'], ([], {}, {}))
+            blocks.extend(section_blocks(spec, col, df, index == 0))
+            for column, style in spec.get('formats', {}).items():
+                col_styles[col + df.columns.get_loc(column)] = style
+            if spec.get('first_row_bold'):
+                row_styles[spec['row'] + 1] = 'header'
+            if 'banner' in spec and index == 0:
+                # Not sized for, so it runs on over the next columns.
+                banners.append((spec['sheet'], Block(
+                    spec['row'] - 2, col,
+                    [[spec['banner']] + [""] * (len(df.columns) - 1)],
+                    'purple', fit=False)))
+    for sheet, block in banners:
+        sheets[sheet][0].append(block)
+    return sheets
+
+
+def column_widths(blocks):
+    """Return column -> width fitting every cell of blocks that fit."""
+    widths = {}
+    for block in blocks:
+        if not block.fit:
+            continue
+        for values in block.rows:
+            for offset, value in enumerate(values):
+                if value is None:
+                    continue
+                text = (block.shown or {}).get(offset, '{}').format(value)
+                col = block.col + offset
+                widths[col] = max(widths.get(col, 0),
+                                  sheet_writer.fit_width(len(text)))
+    return widths
+
+
+def write_sheet(workbook, name, blocks, col_styles, row_styles, styles):
+    """Add a worksheet holding blocks, written one row at a time in order.
+
+    Laying every block out first lets each row be written whole and
+    never returned to, as constant_memory mode needs.
+
+    styles -- style name -> workbook format
+    """
+    worksheet = workbook.add_worksheet(name)
+    widths = column_widths(blocks)
+    widths.update(_fixed_widths.get(name, {}))
+    for col in sorted(set(widths) | set(col_styles)):
+        worksheet.set_column(col, col, widths.get(col),
+                             styles.get(col_styles.get(col)))
+    last = max([block.row + len(block.rows) for block in blocks] + [0])
+    for row in range(last):
+        cells = {}
+        for block in blocks:
+            if not block.row <= row < block.row + len(block.rows):
+                continue
+            for col, value in enumerate(block.rows[row - block.row],
+                                        start=block.col):
+                # Like xlsxwriter, an empty cell without a format
+                # leaves what is already there.
+                if block.style is None and (value is None or value == ''):
+                    continue
+                cells[col] = (value, block.style)
+        if row in row_styles:
+            worksheet.set_row(row, None, styles[row_styles[row]])
+        for col in sorted(cells):
+            value, style = cells[col]
+            worksheet.write(row, col, value, styles.get(style))
+    return worksheet
 
 
 def main():
     """Create a usage report for the current week."""
-    # Get connection object for FTP queries.
-    connection = mal.setup_FTP()
-
     # Get week start and end dates for report based on today's date.
     dates = setup_dates()
 
@@ -88,423 +365,33 @@ def main():
     path = os.path.join(os.getcwd(), "Usage Reports", name)
     if os.path.exists(path):
         os.remove(path)
-    writer = setup_dest_file(path)
-
-    # Grab reference to the workbook and add some formats.
-    workbook = writer.book
-    f_week = workbook.add_format({
-        'bold': True,
-        'font_color': 'white',
-        'bg_color': '#4f81bd'
-        })
-    f_purple = workbook.add_format({
-        'bold': True,
-        'font_color': 'white',
-        'bg_color': '#8064a2'
-        })
-    f_header = workbook.add_format({
-        'bold': True,
-        'border': 0
-        })
-    f_percent = workbook.add_format({'num_format': '0.00%'})
-    f_header_percent = workbook.add_format({
-        'bold': True,
-        'border': 0,
-        'num_format': '0%'
-        })
-
-    # Create a dictionary to label our weeks.
-    weekname = ["This Week", "Last Week", "Last Year"]
-    # Initialize a bunch of counters for column placement.
-    weekcount, C1, C2, C3, C4, C5, C6 = 0, 0, 0, 0, 0, 0, 0
-    # Initialize a bunch of offsets for row placement.
-    R1A, R1B = 1, 17
-    R2 = 1
-    R3 = 1
-    R4A, R4B = 2, 14
-    R5 = 2
-    R6A, R6B = 2, 14
-
-    # Store some pre-written chunks of excel formula for later.
-    weekly_change = ["Weekly Change", "=(B10-G10)/G10",
-                     "=(C10-H10)/H10", "=(D10-I10)/I10"]
-    yearly_change = ["Yearly Change", "=(B10-L10)/L10",
-                     "=(C10-M10)/M10", "=(D10-N10)/N10"]
-
-    # Some bits of SQL code, saved to variables to keep our code cleaner
-    sql_1A = """---- # of Test Results by Date
-    select CONVERT(varchar(10), tr.UpdatedDate,101) as Date,
-    COUNT(tr.testresultid) as Total,
-    sum(case when tr.qtionlinetestsessionid is not null then 1
-    else 0 end) as OnlineTests, sum(case when tr.BubbleSheetID
-    is not null then 1 else 0 end) as BubbleSheets
-    from TestResult tr
-    join VirtualTest vt on vt.VirtualTestID=tr.VirtualTestID
-    join Student s on s.StudentID=tr.StudentID
-    join District d on d.DistrictID=s.DistrictID
-    join State st on st.StateID=d.StateID
-    where tr.UpdatedDate>@weekstart
-    and tr.UpdatedDate<@weekend and d.Name not like '%demo%'
-    and (tr.BubbleSheetID is not null
-    or tr.QTIOnlineTestSessionID is not null)
-    group by CONVERT(varchar(10), tr.UpdatedDate, 101)
-    order by CONVERT(varchar(10), tr.UpdatedDate, 101)"""
-    sql_1B = """
-    select CONVERT(varchar(10), tr.UpdatedDate,101) as Date,
-    COUNT(tr.testresultid) as Total, sum(case when
-    tr.qtionlinetestsessionid is not null then 1 else 0 end)
-    as OnlineTests, sum(case when tr.BubbleSheetID is not null
-    then 1 else 0 end) as BubbleSheets from TestResult tr
-    join VirtualTest vt on vt.VirtualTestID=tr.VirtualTestID
-    join Student s on s.StudentID=tr.StudentID
-    join District d on d.DistrictID=s.DistrictID
-    join State st on st.StateID=d.StateID
-    where tr.UpdatedDate>@weekstart and
-    tr.UpdatedDate<@weekend and d.Name not like '%demo%'
-    and (tr.BubbleSheetID is not null or
-    tr.QTIOnlineTestSessionID is not null) and d.DistrictID
-    not in (2680, 2479) and d.DistrictGroupID not in (112,114)
-    and d.name not like '%frog street%'
-    group by CONVERT(varchar(10), tr.UpdatedDate, 101)
-    order by CONVERT(varchar(10), tr.UpdatedDate, 101)"""
-    sql_2 = """---- # of Test Results by Client
-    select st.Name as State, d.Name as District, count(1) TotalResults,
-    sum(case when tr.qtionlinetestsessionid is not null then 1
-    else 0 end) as OnlineTests, sum(case when tr.BubbleSheetID is not
-    null then 1 else 0 end) as BubbleSheets from TestResult tr
-    join VirtualTest vt on vt.VirtualTestID=tr.VirtualTestID
-    join Student s on s.StudentID=tr.StudentID
-    join District d on d.DistrictID=s.DistrictID
-    join State st on st.StateID=d.StateID
-    where tr.UpdatedDate>@weekstart and tr.UpdatedDate<@weekend
-    and d.Name not like '%demo%'
-    and (tr.BubbleSheetID is not null
-    or tr.QTIOnlineTestSessionID is not null)
-    group by st.Name, d.Name
-    order by count(1) desc"""
-    sql_3 = """---- # of LinkIt Benchmarks by Client
-    select st.Name as State, d.Name as District, count(1) TotalResults,
-    sum(case when tr.qtionlinetestsessionid is not null then 1 else 0
-    end) as OnlineTests, sum(case when tr.BubbleSheetID is not null
-    then 1 else 0 end) as BubbleSheets from TestResult tr
-    join VirtualTest vt on vt.VirtualTestID=tr.VirtualTestID
-    join Student s on s.StudentID=tr.StudentID
-    join District d on d.DistrictID=s.DistrictID
-    join State st on st.StateID=d.StateID
-    where tr.UpdatedDate>@weekstart and tr.UpdatedDate<@weekend
-    and d.Name not like '%demo%' and (tr.BubbleSheetID is not null
-    or tr.QTIOnlineTestSessionID is not null)
-    and vt.Name like '%linkit%form%'
-    group by st.Name, d.Name
-    order by count(1) desc"""
-    sql_4A = """---- # of Online Test Sessions by Start Time ---
-    select CONVERT(varchar(10), qots.startdate,101) as [Date Started],
-    count(1) as [Total # of Online Tests], sum(case when qots.statusid=1
-    then 1 else 0 end) as [# of Created], sum(case when qots.statusid=2
-    then 1 else 0 end) as [# of Started], sum(case when qots.statusid=3
-    then 1 else 0 end) as [# of Paused], sum(case when qots.statusid=5
-    then 1 else 0 end) as [# of Pending Review],
-    sum(case when qots.statusid=4 then 1 else 0 end) as [# of Completed]
-    from QTIOnlineTestSession qots With (nolock)
-    join student s With (nolock) on s.studentid=qots.studentid
-    join district d With (nolock) on d.DistrictID=s.districtid
-    where d.name not like '%demo%' and qots.StartDate>@weekstart
-    and qots.StartDate<@weekend
-    group by CONVERT(varchar(10), qots.startdate,101)
-    order by  CONVERT(varchar(10), qots.startdate,101)"""
-    sql_4B = """---- # of Online Test Sessions by Last Log In Time ---
-    select CONVERT(varchar(10), qots.LastLoginDate,101) as
-    [Date Last Log In], count(1) as [Total # of Online Tests],
-    sum(case when qots.statusid=1 then 1 else 0 end) as [# of Created],
-    sum(case when qots.statusid=2 then 1 else 0 end) as [# of Started],
-    sum(case when qots.statusid=3 then 1 else 0 end) as [# of Paused],
-    sum(case when qots.statusid=5 then 1 else 0 end) as
-    [# of Pending Review], sum(case when qots.statusid=4 then 1 else 0
-    end) as [# of Completed]
-    from QTIOnlineTestSession qots With (nolock)
-    join student s With (nolock) on s.studentid=qots.studentid
-    join district d With (nolock) on d.DistrictID=s.districtid
-    where d.name not like '%demo%' and qots.LastLoginDate>@weekstart
-    and qots.LastLoginDate<@weekend
-    group by CONVERT(varchar(10), qots.LastLoginDate,101)
-    order by  CONVERT(varchar(10), qots.LastLoginDate,101)"""
-    sql_5 = """-- # of Online Test Sessions by Hour by Last Log In Time
-    select CONVERT(varchar(13), dateadd(hour, -4,qots.LastLoginDate),
-    120) as [Hour], count(1) as [Number of Sessions],
-    SUM(case when d.DistrictID=2479 then 1 else 0 end) as [A Beka],
-    sum(case when d.districtgroupid=112 then 1 else 0 end) as BEC,
-    sum(case when d.name like '%frog street%' then 1 else 0 end) as
-    [Frogstreet] from QTIOnlineTestSession qots With (nolock)
-    join student s With (nolock) on s.studentid=qots.studentid
-    join district d With (nolock) on d.DistrictID=s.districtid
-    where d.name not like '%demo%' and qots.LastLoginDate>@weekstart
-    and qots.LastLoginDate<@weekend
-    group by CONVERT(varchar(13),
-    dateadd(hour, -4,qots.LastLoginDate),120)
-    order by  count(1) desc"""
-    sql_6A = """---- # of Results Entry by Date
-    select CONVERT(varchar(10), tr.UpdatedDate,101) as Date,
-    COUNT(tr.testresultid) as Total from TestResult tr
-    join VirtualTest vt on vt.VirtualTestID=tr.VirtualTestID
-    join Student s on s.StudentID=tr.StudentID
-    join District d on d.DistrictID=s.DistrictID
-    join State st on st.StateID=d.StateID
-    where tr.UpdatedDate>@weekstart and tr.UpdatedDate<@weekend
-    and d.Name not like '%demo%' and vt.virtualtestsourceid=3
-    and vt.virtualtesttype in (1,5)
-    group by CONVERT(varchar(10), tr.UpdatedDate, 101)
-    order by CONVERT(varchar(10), tr.UpdatedDate, 101)"""
-    sql_6B = """---- # of Results Entry by District
-    select st.Name as State, d.Name as District,
-    COUNT(tr.testresultid) as Total from TestResult tr
-    join VirtualTest vt on vt.VirtualTestID=tr.VirtualTestID
-    join Student s on s.StudentID=tr.StudentID
-    join District d on d.DistrictID=s.DistrictID
-    join State st on st.StateID=d.StateID
-    where tr.UpdatedDate>@weekstart and tr.UpdatedDate<@weekend
-    and d.Name not like '%demo%' and vt.virtualtestsourceid=3
-    and vt.virtualtesttype in (1,5)
-    group by st.Name, d.Name
-    order by COUNT(tr.testresultid) desc"""
-
-    for week in dates.values():
-        # Part 1A
-        sql = sql_1A
-        R = R1A
-        C = C1
-        N = "# of Results by Date"
-
-        # Get data from database
-        df = pd.read_sql(sql_week(sql, week), connection)
-
-        # Write the data to the file
-        df.to_excel(writer, sheet_name=N, index=False, header=False,
-                    startrow=R+1, startcol=C)
-        worksheet = writer.sheets[N]
-
-        # Then formatted headers
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(R, C+col_num, value, f_header)
-
-        # Add week label above table
-        worksheet.write_string(R-1, C, weekname[weekcount], f_week)
-        # Add 'Total' row at bottom of table
-        worksheet.write_string(R+8, C, 'Total', f_header)
-        worksheet.write(R+8, C+1, df['Total'].sum(), f_header)
-        worksheet.write(R+8, C+2, df['OnlineTests'].sum(), f_header)
-        worksheet.write(R+8, C+3, df['BubbleSheets'].sum(), f_header)
-
-        # Add weekly/yearly change
-        if weekcount is 0:
-            for i in range(4):
-                worksheet.write(R+10, C+i, weekly_change[i], f_header_percent)
-                worksheet.write(R+11, C+i, yearly_change[i], f_header_percent)
-
-        # Part 1B
-        sql = sql_1B
-        R = R1B
-        # Get data from database
-        df = pd.read_sql(sql_week(sql, week), connection)
-        # Write the data to the file, then formatted headers
-        df.to_excel(writer, sheet_name=N, index=False, header=False,
-                    startrow=R+1, startcol=C)
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(R, C+col_num, value, f_header)
-
-        # Add week label above table
-        worksheet.write_string(R-1, C, weekname[weekcount], f_week)
-
-        # Add 'Total' row at bottom of table
-        worksheet.write_string(R+8, C, 'Total', f_header)
-        worksheet.write(R+8, C+1, df['Total'].sum(), f_header)
-        worksheet.write(R+8, C+2, df['OnlineTests'].sum(), f_header)
-        worksheet.write(R+8, C+3, df['BubbleSheets'].sum(), f_header)
-
-        # Add weekly/yearly change
-        if weekcount is 0:
-            for i in range(4):
-                worksheet.write(R+10, C+i,
-                                weekly_change[i].replace("10", "26"),
-                                f_header_percent)
-                worksheet.write(R+11, C+i,
-                                yearly_change[i].replace("10", "26"),
-                                f_header_percent)
-
-        if weekcount is 2:
-            # Not counted for column widths, so we do it at the end
-            long_cell = "Without BEC, A Beka, A List, CEE, Frog Street"
-            worksheet.write(R1B-2, 0, long_cell, f_purple)
-            worksheet.write(R1B-2, 1, "", f_purple)
-            worksheet.write(R1B-2, 2, "", f_purple)
-            worksheet.write(R1B-2, 3, "", f_purple)
-        C1 = C1 + 5
-
-        # Part 2
-        sql = sql_2
-        R = R2
-        C = C2
-        N = "# of Results by Client"
-        # Get data from database
-        df = pd.read_sql(sql_week(sql, week), connection)
-        # Add '%' column
-        tr_sum = df.TotalResults.sum(axis=0)
-        df['%'] = (df['TotalResults']/tr_sum)
-        # Write the data to the file, then formatted headers
-        df.to_excel(writer, sheet_name=N, index=False, header=False,
-                    startrow=R+1, startcol=C)
-        worksheet = writer.sheets[N]
-        # Apply percent format to '%' column
-        worksheet.set_column(C+5, C+5, None, f_percent)
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(R, C+col_num, value, f_header)
-
-        worksheet.write_string(R-1, C, weekname[weekcount], f_week)
-        C2 = C2 + 7
-
-        # Part 3
-        sql = sql_3
-        R = R3
-        C = C3
-        N = "# of LinkIt Benchmarks"
-        # worksheet = writer.sheets[N]
-
-        # Get data from database
-        df = pd.read_sql(sql_week(sql, week), connection)
-        # Add 'Total' row at top
-        df.loc[-1] = ['Total', '', df['TotalResults'].sum(),
-                      df['OnlineTests'].sum(), df['BubbleSheets'].sum()]
-        df.index = df.index + 1  # shifting index
-        df = df.sort_index()  # sorting by index
-
-        # Write the data to the file, then formatted headers
-        df.to_excel(writer, sheet_name=N, index=False, header=False,
-                    startrow=R+1, startcol=C)
-        worksheet = writer.sheets[N]
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(R, C+col_num, value, f_header)
-
-        worksheet.write_string(R-1, C, weekname[weekcount], f_week)
-        worksheet.set_row(R+1, None, f_header)
-
-        C3 = C3 + 6
-        # Part 4A
-        sql = sql_4A
-        R = R4A
-        C = C4
-        N = "# of Online by Date"
-
-        # Get data from database
-        df = pd.read_sql(sql_week(sql, week), connection)
-        # Write the data to the file, then formatted headers
-        df.to_excel(writer, sheet_name=N, index=False, header=False,
-                    startrow=R+1, startcol=C)
-        worksheet = writer.sheets[N]
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(R, C+col_num, value, f_header)
-
-        worksheet.write_string(R-2, C, weekname[weekcount], f_week)
-        worksheet.write_string(R-1, C, "By Start Date", f_header)
-
-        # Part 4B
-        sql = sql_4B
-        R = R4B
-        # Get data from database
-        df = pd.read_sql(sql_week(sql, week), connection)
-        # Write the data to the file, then formatted headers
-        df.to_excel(writer, sheet_name=N, index=False, header=False,
-                    startrow=R+1, startcol=C)
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(R, C+col_num, value, f_header)
-
-        worksheet.write_string(R-2, C, weekname[weekcount], f_week)
-        worksheet.write_string(R-1, C, "By Last Login Date", f_header)
-
-        C4 = C4 + 8
-
-        # Part 5
-        sql = sql_5
-        R = R5
-        C = C5
-        N = "# of Online by Hour"
-
-        # Get data from database
-        df = pd.read_sql(sql_week(sql, week), connection)
-        # Add some columns at the end
-        df['Others'] = (df['Number of Sessions']
-                        - (df['A Beka'] + df['BEC'] + df['Frogstreet']))
-        df['% of A Beka'] = df['A Beka'] / df['Number of Sessions']
-        df['% of BEC'] = df['BEC'] / df['Number of Sessions']
-        df['% of Frog Street'] = df['Frogstreet'] / df['Number of Sessions']
-        df['% of Others'] = df['Others'] / df['Number of Sessions']
-
-        # Write the data to the file, then formatted headers
-        df.to_excel(writer, sheet_name=N, index=False, header=False,
-                    startrow=R+1, startcol=C)
-        worksheet = writer.sheets[N]
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(R, C+col_num, value, f_header)
-
-        worksheet.write_string(R-2, C, weekname[weekcount], f_week)
-        worksheet.write_string(R-1, C, "By Last Login Date", f_header)
-        C5 = C5 + 11
-
-        # Part 6A
-        sql = sql_6A
-        R = R6A
-        C = C6
-        N = "# of Data Locker"
-
-        # Get data from database
-        df = pd.read_sql(sql_week(sql, week), connection)
-
-        # Write the data to the file, then formatted headers
-        df.to_excel(writer, sheet_name=N, index=False, header=False,
-                    startrow=R+1, startcol=C)
-        worksheet = writer.sheets[N]
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(R, C+col_num, value, f_header)
-
-        worksheet.write_string(R-1, C, weekname[weekcount], f_week)
-
-        # Add Total to bottom
-        worksheet.write_string(R+8, C, "Total", f_header)
-        worksheet.write(R+8, C+1, df["Total"].sum(), f_header)
-
-        if weekcount == 0:
-            worksheet.write_string(R-2, C, "By Date", f_week)
-
-        # Part 6B
-        sql = sql_6B
-        R = R6B
-        # Get data from database
-        df = pd.read_sql(sql_week(sql, week), connection)
-        # Write the data to the file, then formatted headers
-        df.to_excel(writer, sheet_name=N, index=False, header=False,
-                    startrow=R+1, startcol=C)
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(R, C+col_num, value, f_header)
-
-        worksheet.write_string(R-1, C, weekname[weekcount], f_week)
-        if (weekcount == 0):
-            worksheet.write_string(R-2, C, "By Client", f_week)
-        # Adjust column widths
-        C6 = C6 + 4
-
-        weekcount = weekcount + 1
-    writer.save()
-    # Handle some special formatting by hijacking Excel.
-    excel = win32.DispatchEx('Excel.Application')
-    wb = excel.Workbooks.Open(path)
-    for ws in wb.Worksheets:
-        ws.Columns.AutoFit()
-    ws = wb.Worksheets("# of Results by Date")
-    ws.Columns(1).ColumnWidth = 15
-    ws = wb.Worksheets("# of Online by Hour")
-    ws.Range('G:J,R:U,AC:AF').NumberFormat = '0%'
-    ws = wb.Worksheets("# of Data Locker")
-    ws.Range("A4:J10")
-    wb.Save()
-    excel.Application.Quit()
+
+    # Every table comes from the daily rollup; only days it doesn't
+    # have yet, and all of This Week, are fetched from the server.
+    rows = usage_rollup.rollup(
+        [day for week in dates.values() for day in week_days(week)],
+        connection_pool.setup_FTP, live_from=dates["This Week"][0])
+    tables = {}
+    for week_name, (start, end) in dates.items():
+        in_week = ((rows.Date >= pd.Timestamp(start))
+                   & (rows.Date < pd.Timestamp(end)))
+        tables[week_name] = section_tables(rows[in_week])
+
+    workbook = sheet_writer.open_workbook(path)
+    styles = {
+        'week': workbook.add_format({
+            'bold': True, 'font_color': 'white', 'bg_color': '#4f81bd'}),
+        'purple': workbook.add_format({
+            'bold': True, 'font_color': 'white', 'bg_color': '#8064a2'}),
+        'header': workbook.add_format({'bold': True, 'border': 0}),
+        'header percent': workbook.add_format({
+            'bold': True, 'border': 0, 'num_format': '0%'}),
+        'percent': workbook.add_format({'num_format': '0.00%'}),
+        'whole percent': workbook.add_format({'num_format': '0%'}),
+    }
+    for sheet, (blocks, col_styles, row_styles) in layout(tables).items():
+        write_sheet(workbook, sheet, blocks, col_styles, row_styles, styles)
+    workbook.close()
 
 
 def create_report():
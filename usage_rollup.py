@@ -0,0 +1,214 @@
+"""Local daily rollup of usage counts, so reports only query new days.
+
+The usage report covers this week, last week and the same week last
+year. Each day before the report's current week is fetched once,
+rolled up by district, source, session status and hour, and kept in a
+SQLite file. A report then fetches only the days it doesn't have yet,
+plus every day of the current week, which are fetched fresh and never
+stored.
+
+Counts are by UpdatedDate and LastLoginDate, which move when a result
+is saved again or a session logged in to again. So a stored day keeps
+counting what was on it when it was fetched: a result or session that
+moves on to a later day is counted on both. Rescanning the whole
+current week on every run keeps that from happening within This Week,
+but Last Week and Last Year may still hold a few moved rows.
+
+Each rollup row counts, for one day and district, one Source:
+- 'result': test results taken online or on a bubble sheet, or
+  entered through the data locker; the Online, Bubble, DataLocker and
+  LinkIt flags say which, and whether the test is a LinkIt benchmark
+  form
+- 'session start', 'session login': online test sessions by the day
+  they were started, last logged in to; Status is the session's status
+  and, for 'session login', Hour the hour of the login
+Demo districts are left out. Days are server days, running from
+midnight to midnight.
+"""
+import datetime as dt
+import os
+import os.path
+import sqlite3
+import pandas as pd
+import queries
+
+_store_path = os.path.join(os.getcwd(), "Cache", "Usage", "rollup.sqlite")
+_columns = ['Date', 'Hour', 'DistrictID', 'District', 'DistrictGroupID',
+            'State', 'Source', 'Status', 'Online', 'Bubble', 'DataLocker',
+            'LinkIt', 'Count']
+
+# One pass over the window's test results, counted by every flag the
+# report's tables filter on.
+_results = queries.register("usage.rollup_results", """
+declare @start datetime = ?, @end datetime = ?
+
+select convert(date, tr.UpdatedDate) as Date, null as Hour,
+d.DistrictID, d.Name as District, d.DistrictGroupID, st.Name as State,
+'result' as Source, null as Status,
+case when tr.QTIOnlineTestSessionID is not null then 1 else 0 end
+as Online,
+case when tr.BubbleSheetID is not null then 1 else 0 end as Bubble,
+case when vt.virtualtestsourceid=3 and vt.virtualtesttype in (1,5)
+then 1 else 0 end as DataLocker,
+case when vt.Name like '%linkit%form%' then 1 else 0 end as LinkIt,
+count(1) as Count
+from TestResult tr
+join VirtualTest vt on vt.VirtualTestID=tr.VirtualTestID
+join Student s on s.StudentID=tr.StudentID
+join District d on d.DistrictID=s.DistrictID
+join State st on st.StateID=d.StateID
+where tr.UpdatedDate>=@start and tr.UpdatedDate<@end
+and d.Name not like '%demo%'
+and (tr.BubbleSheetID is not null or tr.QTIOnlineTestSessionID is not null
+or (vt.virtualtestsourceid=3 and vt.virtualtesttype in (1,5)))
+group by convert(date, tr.UpdatedDate), d.DistrictID, d.Name,
+d.DistrictGroupID, st.Name,
+case when tr.QTIOnlineTestSessionID is not null then 1 else 0 end,
+case when tr.BubbleSheetID is not null then 1 else 0 end,
+case when vt.virtualtestsourceid=3 and vt.virtualtesttype in (1,5)
+then 1 else 0 end,
+case when vt.Name like '%linkit%form%' then 1 else 0 end""")
+
+# Every online test session started or last logged in to in the window,
+# one row each; session_rows rolls them up both ways.
+_sessions = queries.register("usage.rollup_sessions", """
+declare @start datetime = ?, @end datetime = ?
+
+select qots.StartDate, qots.LastLoginDate, qots.statusid as Status,
+d.DistrictID, d.Name as District, d.DistrictGroupID, st.Name as State
+from QTIOnlineTestSession qots With (nolock)
+join student s With (nolock) on s.studentid=qots.studentid
+join district d With (nolock) on d.DistrictID=s.districtid
+left join State st With (nolock) on st.StateID=d.StateID
+where d.name not like '%demo%'
+and ((qots.StartDate>=@start and qots.StartDate<@end)
+or (qots.LastLoginDate>=@start and qots.LastLoginDate<@end))""")
+
+# Stored days are fetched again once either query changes.
+_digest = _results.digest + _sessions.digest
+
+
+def connect_store():
+    """Open the rollup store, creating it if needed."""
+    os.makedirs(os.path.dirname(_store_path), exist_ok=True)
+    store = sqlite3.connect(_store_path, timeout=60)
+    columns = [row[1] for row in store.execute("pragma table_info(daily)")]
+    if columns and columns != _columns:
+        # Laid out for older queries; every day is fetched again.
+        store.execute("drop table daily")
+        store.execute("drop table if exists days")
+    store.execute("""create table if not exists daily (
+        Date text, Hour integer, DistrictID integer, District text,
+        DistrictGroupID integer, State text, Source text,
+        Status integer, Online integer, Bubble integer,
+        DataLocker integer, LinkIt integer, Count integer)""")
+    store.execute(
+        "create index if not exists daily_date on daily (Date)")
+    store.execute("""create table if not exists days (
+        Date text primary key, digest text, fetched text)""")
+    return store
+
+
+def day_key(day):
+    """Return how a day is written in the store."""
+    return day.strftime("%Y-%m-%d")
+
+
+def runs(days):
+    """Group days into (first day, day after the last) ranges."""
+    ranges = []
+    for day in sorted(days):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + dt.timedelta(days=1)
+        else:
+            ranges.append([day, day + dt.timedelta(days=1)])
+    return [tuple(each) for each in ranges]
+
+
+def session_rows(sessions, start, end):
+    """Roll sessions up by the day they started and last logged in.
+
+    Only times from start up to end are counted. Logins are also
+    counted by hour, in server time like the days.
+    """
+    frames = []
+    for column, source in [('StartDate', 'session start'),
+                           ('LastLoginDate', 'session login')]:
+        times = sessions[column]
+        inside = (times >= pd.Timestamp(start)) & (times < pd.Timestamp(end))
+        keys = [times[inside].dt.normalize().rename('Date')]
+        if source == 'session login':
+            keys.append(times[inside].dt.hour.rename('Hour'))
+        keys.extend(sessions.loc[inside, key] for key in [
+            'DistrictID', 'District', 'DistrictGroupID', 'State', 'Status'])
+        frames.append(sessions[inside].groupby(keys, dropna=False).size()
+                      .rename('Count').reset_index().assign(Source=source))
+    return pd.concat(frames, ignore_index=True).assign(
+        Online=0, Bubble=0, DataLocker=0, LinkIt=0)
+
+
+def fetch(cnxn, start, end):
+    """Return the rollup for the days from start up to end."""
+    params = [dt.datetime.combine(day, dt.time()) for day in (start, end)]
+    results = queries.read(_results, cnxn, params, cache=False)
+    sessions = queries.read(_sessions, cnxn, params, cache=False,
+                            parse_dates=['StartDate', 'LastLoginDate'])
+    df = pd.concat([results, session_rows(sessions, start, end)],
+                   ignore_index=True)
+    df['Date'] = pd.to_datetime(df.Date)
+    return df[_columns]
+
+
+def rollup(days, connect, live_from=None):
+    """Return the rollup rows for days, fetching what isn't stored.
+
+    days -- datetime.dates; those before live_from are stored as they
+        are fetched, later ones are always fetched fresh
+    connect -- function returning a connection, called only if the
+        server has to be asked
+    live_from -- first day that may still change, e.g. the start of the
+        report's current week (default: today)
+    """
+    if live_from is None:
+        live_from = dt.date.today()
+    days = set(days)
+    closed = sorted(day for day in days if day < live_from)
+    store = connect_store()
+    cnxn = None
+    try:
+        stored = {row[0] for row in store.execute(
+            "select Date from days where digest = ?", [_digest])}
+        missing = [day for day in closed if day_key(day) not in stored]
+        live = sorted(day for day in days if day >= live_from)
+        if missing or live:
+            cnxn = connect()
+        for start, end in runs(missing):
+            df = fetch(cnxn, start, end)
+            keys = [day_key(start + dt.timedelta(days=offset))
+                    for offset in range((end - start).days)]
+            # Replace the run's days as a whole, so a day is either
+            # stored complete or not at all.
+            store.executemany("delete from daily where Date = ?",
+                              [(key,) for key in keys])
+            df.assign(Date=df.Date.dt.strftime("%Y-%m-%d")).to_sql(
+                'daily', store, if_exists='append', index=False)
+            store.executemany(
+                "insert or replace into days values (?, ?, ?)",
+                [(key, _digest, str(dt.datetime.now())) for key in keys])
+            store.commit()
+            print("Usage rollup: stored {} to {}, {} rows".format(
+                start, end - dt.timedelta(days=1), len(df)))
+        keys = [day_key(day) for day in closed]
+        frames = [pd.read_sql(
+            "select * from daily where Date in ({})".format(
+                ", ".join("?" * len(keys))),
+            store, params=keys, parse_dates=['Date'])] if keys else []
+        for start, end in runs(live):
+            frames.append(fetch(cnxn, start, end))
+    finally:
+        if cnxn is not None:
+            cnxn.close()
+        store.close()
+    if not frames:
+        return pd.DataFrame(columns=_columns)
+    return pd.concat(frames, ignore_index=True)